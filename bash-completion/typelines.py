@@ -2,12 +2,13 @@
 
 
 
-_shtab_typelines_option_strings=('-h' '--help' '-v' '--version' '-b' '--backend' '-d' '--detect-keyboard')
+_shtab_typelines_option_strings=('-h' '--help' '-v' '--version' '-b' '--backend' '-d' '--detect-keyboard' '--perf-log' '--serial' '--baud' '--flow' '--chunk-size' '--xtest' '--transcript' '--clipboard-size' '--clipboard-bytes' '--clipboard-filter' '--record-events' '--profile' '--tracemalloc' '--profile-dir' '--session' '--no-session' '--cache' '--no-cache' '--templates-dir' '--inventory')
 
 
 
 _shtab_typelines__b_choices=('xorg' 'uinput')
 _shtab_typelines___backend_choices=('xorg' 'uinput')
+_shtab_typelines___flow_choices=('xonxoff' 'rtscts' 'none')
 
 _shtab_typelines__h_nargs=0
 _shtab_typelines___help_nargs=0
@@ -15,6 +16,11 @@ _shtab_typelines__v_nargs=0
 _shtab_typelines___version_nargs=0
 _shtab_typelines__d_nargs=0
 _shtab_typelines___detect_keyboard_nargs=0
+_shtab_typelines___profile_nargs=0
+_shtab_typelines___tracemalloc_nargs=0
+_shtab_typelines___no_session_nargs=0
+_shtab_typelines___no_cache_nargs=0
+_shtab_typelines___xtest_nargs=0
 
 
 # $1=COMP_WORDS[1]
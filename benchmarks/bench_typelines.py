@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""Headless benchmarks for Type Lines.
+Generate large templates, then time the import, render, navigation and
+typing code paths of `typelines.py` without a display or a real
+keyboard. Results are compared against a stored baseline and the exit
+status is 1 when any result regressed beyond the tolerance.
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+
+benchdir = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(benchdir.parent))
+
+import typelines
+
+# Metrics where a larger value is better, all others are durations
+throughput_metrics = (
+    'navigation_steps_per_second',
+    'typing_chars_per_second',
+    'serial_bytes_per_second',
+    'xtest_chars_per_second',
+    )
+
+
+def parse_arguments():
+    """Create command line arguments. Returns a parser object."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '-s', '--sizes',
+        nargs='+',
+        type=int,
+        default=[1_000, 10_000, 100_000],
+        help='Template sizes in lines to benchmark (up to 1000000).',
+        )
+    parser.add_argument(
+        '--baseline',
+        type=pathlib.Path,
+        default=benchdir / 'baseline.json',
+        help='Baseline results file to compare against.',
+        )
+    parser.add_argument(
+        '-t', '--tolerance',
+        type=float,
+        default=0.5,
+        help='Allowed slowdown as a fraction of the baseline (0.5 = 50%%).',
+        )
+    parser.add_argument(
+        '-u', '--update-baseline',
+        nargs='*',
+        metavar='METRIC',
+        help=(
+            'Write the results as the new baseline instead of comparing, '
+            'only the named metrics if any are given.'
+            ),
+        )
+    parser.add_argument(
+        '--xtest',
+        action='store_true',
+        help=(
+            'Also type with XTest into a window on a private Xvfb display '
+            '(Linux only, needs Xvfb and python-xlib).'
+            ),
+        )
+    return parser
+
+
+class FakeController:
+    """Stand-in for `pynput.keyboard.Controller` that records keys."""
+
+    def __init__(self):
+        self.keys = 0
+
+    def press(self, key):
+        self.keys += 1
+
+    def release(self, key):
+        self.keys += 1
+
+    def type(self, string):
+        for character in string:
+            self.press(character)
+            self.release(character)
+
+
+class FakeListener:
+    """Stand-in for the listener whose `_suppress` the filter sets."""
+
+    _suppress = False
+
+
+class FakeKeyEvent:
+    """Stand-in for the `KBDLLHOOKSTRUCT` passed to the Windows filter."""
+
+    def __init__(self, vk):
+        self.vkCode = vk
+
+
+def generate_template(size, numvars=20, commentevery=10):
+    """Return a template of `size` body lines with `##var:` variables
+    and a dense block of comment lines every `commentevery` lines.
+    """
+    lines = [f"##var:var{n}=a{n},b{n},c{n}" for n in range(numvars)]
+    for n in range(size):
+        if n % commentevery < 3:
+            lines.append(f"# comment {n} " + 'x' * 40)
+        elif n % commentevery == 3:
+            lines.append(f"## hidden comment {n}")
+        elif n % commentevery == 4:
+            lines.append('')
+        else:
+            lines.append(
+                f"interface {{var{n % numvars}}} {n} "
+                f"description {{var{(n + 1) % numvars}:_>12}}"
+                )
+    return '\n'.join(lines)
+
+
+def timed(function, *args):
+    """Return the result and the duration of a function call."""
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_size(size):
+    """Run every benchmark against a template of `size` lines."""
+    results = {}
+    text = generate_template(size)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        templatefile = pathlib.Path(tmpdir) / 'template.txt'
+        templatefile.write_text(text)
+        tracemalloc.start()
+        (text, varsdict), results['import_seconds'] = timed(
+            typelines.readtemplate, templatefile
+            )
+        values = {k: v[0] for k, v in varsdict.items()}
+        (lines, _), results['render_seconds'] = timed(
+            typelines.render_lines, text, values, False
+            )
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    results['peak_memory_mb'] = peak / 2**20
+    store = typelines.LineStore(lines)
+    results['line_store_mb'] = store.nbytes() / 2**20
+
+    # Move through the LineStore like `cyclelist` does in the list
+    steps = min(size, 100_000)
+    start = time.perf_counter()
+    pos = 0
+    for _ in range(steps):
+        pos = typelines.next_position(
+            store.comment_flags().__getitem__, len(store), pos, 1, True
+            )
+    results['navigation_steps_per_second'] = (
+        steps / (time.perf_counter() - start)
+        )
+
+    typelines.init_perf_stats()
+    controller = FakeController()
+    typed = lines[:min(len(lines), 10_000)]
+    start = time.perf_counter()
+    for line in typed:
+        typelines.typequeueditem(
+            controller,
+            (line, time.perf_counter(), time.perf_counter(), None),
+            )
+    results['typing_chars_per_second'] = (
+        sum(map(len, typed)) / (time.perf_counter() - start)
+        )
+    return results
+
+
+def peak_allocation(event_filter, events):
+    """Return the peak memory allocated while filtering the events."""
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    for event in events:
+        event_filter(0x0100, event)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - before
+
+
+def bench_event_filter(calls=1_000_000):
+    """Time `win32_event_filter` per key event and measure the memory it
+    allocates. The filter runs in the system keyboard hook, so it must
+    stay fast and allocate nothing.
+    """
+    results = {}
+    typelines.listener = FakeListener()
+    typelines.is_keyboard_hooked = True
+    typelines.macro_vks = frozenset((0x72, 0x73, 0x74, 0x75))  # F3 to F6
+    # Key down events for A (not a macro key) and F4 (a macro key)
+    events = [FakeKeyEvent(0x41), FakeKeyEvent(0x73)] * (calls // 2)
+    event_filter = typelines.win32_event_filter
+    start = time.perf_counter()
+    for event in events:
+        event_filter(0x0100, event)
+    results['event_filter_ns'] = (
+        (time.perf_counter() - start) / len(events) * 1e9
+        )
+    events = events[:10_000]
+    results['event_filter_alloc_bytes'] = (
+        peak_allocation(event_filter, events)
+        - peak_allocation(lambda msg, data: None, events)
+        )
+    return results
+
+
+def bench_serial(lines=50):
+    """Send lines through `SerialWriter` with XON/XOFF flow control to a
+    simulated console with a 64 byte buffer processing 2000 bytes per
+    second. Measure the rate achieved and the bytes the console lost.
+    """
+    from fake_console import FakeConsole
+    console = FakeConsole(buffersize=64, rate=2000, xonxoff=True)
+    writer = typelines.SerialWriter(
+        console.path, baud=115200, flow='xonxoff', chunksize=16
+        )
+    try:
+        for n in range(lines):
+            line = f"interface ethernet 1/{n} description uplink-{n}"
+            typelines.typequeueditem(
+                writer, (line, None, time.perf_counter(), None), writer.eol
+                )
+        console.wait_idle()
+    finally:
+        writer.close()
+        console.close()
+    return {
+        'serial_bytes_per_second': writer.rate(),
+        'serial_lost_bytes': console.lost,
+        }
+
+
+def bench_xtest(lines=200):
+    """Type lines with `XTestWriter` into a window on a private Xvfb
+    display and measure the rate until the window has read every key,
+    and the lines which arrived different from what was typed.
+    Return None if XTest or Xvfb is not available.
+    """
+    import xtest_check
+    typed = [
+        f"interface ethernet 1/{n} description Uplink-{n} (port #{n})"
+        for n in range(lines)
+        ]
+    try:
+        with xtest_check.xvfb_display() as displayname:
+            received, seconds = xtest_check.type_and_read(displayname, typed)
+    except (OSError, ImportError) as e:
+        print(f"Skipping XTest: {e}")
+        return None
+    expected = ''.join(f"{line}\n" for line in typed)
+    return {
+        'xtest_chars_per_second': len(received) / seconds if seconds else 0.0,
+        'xtest_wrong_lines': len(xtest_check.differences(expected, received)),
+        }
+
+
+def bench_inventory(rows=50_000, lookups=10_000):
+    """Time building the index of an inventory CSV file and the prefix
+    lookups made while a key value is typed in the import dialog.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inventoryfile = pathlib.Path(tmpdir) / 'inventory.csv'
+        inventoryfile.write_text(
+            'sitename,sitenumber,os,vlanname\n' + ''.join(
+                f"site{n:05d},{n},ios,vlan{n}\n" for n in range(rows)
+                )
+            )
+        typelines.inventory_cache = {}
+        inventory, results['inventory_index_seconds'] = timed(
+            typelines.load_inventory, inventoryfile
+            )
+        prefixes = [f"SITE{n:05d}"[:4 + n % 6] for n in range(lookups)]
+        start = time.perf_counter()
+        for prefix in prefixes:
+            typelines.load_inventory(inventoryfile)
+            typelines.inventory_matches(inventory, prefix)
+        results['inventory_lookup_us'] = (
+            (time.perf_counter() - start) / lookups * 1e6
+            )
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of messages for each regressed result."""
+    regressions = []
+    for size, metrics in results.items():
+        for metric, value in metrics.items():
+            expected = baseline.get(size, {}).get(metric)
+            if expected is None:
+                continue
+            if metric in throughput_metrics:
+                regressed = value < expected / (1 + tolerance)
+            else:
+                regressed = value > expected * (1 + tolerance)
+            if regressed:
+                regressions.append(
+                    f"{size} lines: {metric} {value:.4g} "
+                    f"(baseline {expected:.4g})"
+                    )
+    return regressions
+
+
+def update_baseline(results, baseline, metrics):
+    """Return the baseline with the results of the named metrics, or
+    all the results if no metrics are named.
+    """
+    if not metrics:
+        return results
+    for group, values in results.items():
+        for metric in metrics:
+            if metric in values:
+                baseline.setdefault(group, {})[metric] = values[metric]
+    return baseline
+
+
+def main():
+    """Run the benchmarks and compare or store the results."""
+    args = parse_arguments().parse_args()
+    results = {}
+    for size in args.sizes:
+        results[str(size)] = bench_size(size)
+        print(f"{size} lines")
+        for metric, value in results[str(size)].items():
+            print(f"  {metric:<30}{value:>16.4f}")
+    results['event_filter'] = bench_event_filter()
+    print('event filter')
+    for metric, value in results['event_filter'].items():
+        print(f"  {metric:<30}{value:>16.4f}")
+    results['inventory'] = bench_inventory()
+    print('inventory')
+    for metric, value in results['inventory'].items():
+        print(f"  {metric:<30}{value:>16.4f}")
+    if os.name == 'posix':
+        results['serial'] = bench_serial()
+        print('serial console')
+        for metric, value in results['serial'].items():
+            print(f"  {metric:<30}{value:>16.4f}")
+    if args.xtest:
+        xtest = bench_xtest()
+        if xtest:
+            results['xtest'] = xtest
+            print('XTest')
+            for metric, value in xtest.items():
+                print(f"  {metric:<30}{value:>16.4f}")
+    if args.update_baseline is not None:
+        unknown = set(args.update_baseline).difference(
+            *(values.keys() for values in results.values())
+            )
+        if unknown:
+            print(f"No results for {', '.join(sorted(unknown))}")
+            return 2
+        baseline = {}
+        if args.baseline.exists():
+            baseline = json.loads(args.baseline.read_text())
+        results = update_baseline(results, baseline, args.update_baseline)
+        args.baseline.write_text(json.dumps(results, indent=2) + '\n')
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if not args.baseline.exists():
+        print(f"No baseline found at {args.baseline}")
+        return 0
+    baseline = json.loads(args.baseline.read_text())
+    regressions = compare(results, baseline, args.tolerance)
+    for message in regressions:
+        print(f"REGRESSION {message}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""A pseudo terminal standing in for a slow network device console.
+The console receives bytes into a small input buffer and processes them
+at a fixed rate. Bytes arriving while the buffer is full are lost, like
+a UART overrun. With XON/XOFF flow control the console sends XOFF when
+its buffer is three quarters full and XON when it is a quarter full.
+"""
+
+import os
+import pty
+import select
+import threading
+import time
+import tty
+
+XON, XOFF = b'\x11', b'\x13'
+
+
+class FakeConsole:
+    """Slow, buffer limited console on the slave side of a pty.
+    Open `path` as the serial device.
+    """
+
+    def __init__(self, buffersize=64, rate=2000, xonxoff=True):
+        self.buffersize = buffersize
+        self.rate = rate
+        self.xonxoff = xonxoff
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        self.path = os.ttyname(self.slave)
+        self.buffered = 0
+        self.received = bytearray()
+        self.processed = 0
+        self.lost = 0
+        self.paused = False
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Receive bytes, process them at `rate` and send XOFF/XON."""
+        last = time.perf_counter()
+        while not self.stop.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.001)
+            if ready:
+                data = os.read(self.master, 4096)
+                room = self.buffersize - self.buffered
+                self.received += data[:room]
+                self.buffered += min(room, len(data))
+                self.lost += max(0, len(data) - room)
+            now = time.perf_counter()
+            done = min(self.buffered, int((now - last) * self.rate))
+            if done:
+                self.buffered -= done
+                self.processed += done
+                last = now
+            elif not self.buffered:
+                last = now
+            if not self.xonxoff:
+                continue
+            if not self.paused and self.buffered >= self.buffersize * 3 // 4:
+                os.write(self.master, XOFF)
+                self.paused = True
+            elif self.paused and self.buffered <= self.buffersize // 4:
+                os.write(self.master, XON)
+                self.paused = False
+
+    def wait_idle(self, timeout=30):
+        """Wait until every received byte has been processed."""
+        deadline = time.perf_counter() + timeout
+        while self.buffered and time.perf_counter() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        """Stop the console and close the pty."""
+        self.stop.set()
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""Replay a key event trace through the keyboard listener dispatch.
+Feed the events recorded with `typelines.py --record-events FILE` to
+the `win32_event_filter`, `on_press` and `on_release` callbacks of
+`typelines.py` at the original speed or as fast as possible, without a
+display or a real keyboard. The macro actions run on a thread standing
+in for the Tk main loop, and the lines are typed by the real controller
+thread into a fake controller. Report the handling cost of each event
+and the typed lines which were dropped or typed late.
+"""
+
+import argparse
+import json
+import pathlib
+import queue
+import sys
+import threading
+import time
+
+benchdir = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(benchdir.parent))
+
+import typelines
+from bench_typelines import FakeController, FakeKeyEvent, FakeListener
+
+
+def parse_arguments():
+    """Create command line arguments. Returns a parser object."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        'trace',
+        type=pathlib.Path,
+        help='Key event trace written by --record-events.',
+        )
+    parser.add_argument(
+        '-f', '--fast',
+        action='store_true',
+        help='Replay the events as fast as possible, not at original speed.',
+        )
+    parser.add_argument(
+        '--late',
+        type=float,
+        default=100,
+        metavar='MS',
+        help=(
+            'Count lines typed more than MS milliseconds after the key '
+            'press as late. (default: %(default)s)'
+            ),
+        )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=10,
+        metavar='SECONDS',
+        help=(
+            'Count lines not typed SECONDS after the last event as dropped. '
+            '(default: %(default)s)'
+            ),
+        )
+    return parser
+
+
+class FakeVar:
+    """Stand-in for the tkinter variables read by `on_press`."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class FakeRoot:
+    """Stand-in for the Tk root, running the callbacks posted with
+    `after` in order on one thread like the Tk main loop.
+    """
+
+    def __init__(self):
+        self.calls = queue.Queue()
+        threading.Thread(target=self.mainloop, daemon=True).start()
+
+    def after(self, ms, function, *args):
+        self.calls.put((function, args))
+
+    def mainloop(self):
+        while True:
+            function, args = self.calls.get()
+            function(*args)
+            self.calls.task_done()
+
+
+class ReplayList:
+    """A list of lines with a selected position, standing in for the
+    listbox, with the macro key actions of `update_macro_keys`.
+    """
+
+    def __init__(self, size=1000):
+        self.lines = typelines.LineStore(
+            f"interface ethernet 1/{n} description uplink-{n}"
+            for n in range(size)
+            )
+        self.position = 0
+        self.queued = 0
+
+    def move(self, step):
+        self.position = typelines.next_position(
+            self.lines.comment_flags().__getitem__, len(self.lines),
+            self.position, step,
+            )
+
+    def type_line(self):
+        pressed, typelines.keypress_time = typelines.keypress_time, None
+        typelines.keyboard_queue.put(
+            (self.lines[self.position], pressed, time.perf_counter(), None)
+            )
+        self.queued += 1
+
+    def macro_table(self):
+        """Return the actions when not reversed and reversed by macro
+        name, like `update_macro_keys`.
+        """
+        return {
+            'nextlist': (lambda: None, lambda: None),
+            'selnext': (lambda: self.move(1), lambda: self.move(-1)),
+            'selprev': (lambda: self.move(-1), lambda: self.move(1)),
+            'repeat': (self.type_line, self.type_line),
+            'forward': (
+                lambda: (self.type_line(), self.move(1)),
+                lambda: (self.type_line(), self.move(-1)),
+                ),
+            }
+
+
+def read_trace(tracefile):
+    """Return the macro keys and the events of a trace file."""
+    with open(tracefile) as trace:
+        header = json.loads(trace.readline())
+        events = [json.loads(line) for line in trace if line.strip()]
+    return header['macro_keys'], events
+
+
+def setup(macro_keys, replaylist, controller):
+    """Set the `typelines` globals used by the dispatch code. Keys are
+    matched by their recorded names instead of pynput key objects.
+    """
+    actions = replaylist.macro_table()
+    # The first macro wins if the same key is chosen twice
+    typelines.macro_actions = {
+        macro_keys[name][0]: actions[name] for name in reversed(actions)
+        }
+    typelines.macro_vks = frozenset(
+        vk for _, vk in macro_keys.values() if vk is not None
+        )
+    typelines.is_keyboard_hooked = True
+    typelines.listener = FakeListener()
+    typelines.root = FakeRoot()
+    typelines.reversenextbool = FakeVar(False)
+    typelines.keypress_time = None
+    typelines.keyboard_queue = queue.Queue()
+    typelines.transcript_ring = None
+    typelines.serial_writer = controller
+    controller.eol = ''
+    threading.Thread(target=typelines.controller_worker, daemon=True).start()
+
+
+def replay(events, fast):
+    """Feed the events to the dispatch code. Return the handling time
+    of each event in seconds.
+    """
+    costs = []
+    start = time.perf_counter()
+    for event in events:
+        if not fast:
+            delay = start + event['time'] - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        message = 0x0100 if event['press'] else 0x0101
+        began = time.perf_counter()
+        # Keys other than macro keys are recorded without their vk
+        vk = event['vk'] or 0
+        typelines.win32_event_filter(message, FakeKeyEvent(vk))
+        if event['press']:
+            typelines.on_press(event['key'])
+        else:
+            typelines.on_release(event['key'])
+        costs.append(time.perf_counter() - began)
+    return costs
+
+
+def wait_typed(timeout):
+    """Wait until the queued lines are typed or the timeout expires.
+    Return the number of lines not typed.
+    """
+    typelines.root.calls.join()
+    deadline = time.perf_counter() + timeout
+    while typelines.keyboard_queue.unfinished_tasks:
+        if time.perf_counter() > deadline:
+            break
+        time.sleep(0.01)
+    return typelines.keyboard_queue.unfinished_tasks
+
+
+def main():
+    """Replay the trace and print the results."""
+    args = parse_arguments().parse_args()
+    macro_keys, events = read_trace(args.trace)
+    replaylist = ReplayList()
+    controller = FakeController()
+    typelines.init_perf_stats(maxlen=max(len(events), 1))
+    setup(macro_keys, replaylist, controller)
+    costs = sorted(replay(events, args.fast))
+    dropped = wait_typed(args.timeout)
+    latencies = typelines.perf_samples['press_to_first_char']
+    late = sum(1 for latency in latencies if latency * 1000 > args.late)
+    print(f"{len(events)} events, {replaylist.queued} lines typed")
+    for pct in (50, 95, 99, 100):
+        cost = typelines.percentile(costs, pct) if costs else 0
+        print(f"  {f'event handling p{pct} (us)':<30}{cost * 1e6:>16.4f}")
+    for stage, summary in typelines.perf_summary().items():
+        if summary['count'] and stage != 'chars_per_second':
+            print(f"  {f'{stage} p99 (ms)':<30}{summary['p99'] * 1000:>16.4f}")
+    print(f"  {f'late (> {args.late:g} ms)':<30}{late:>16}")
+    print(f"  {'dropped':<30}{dropped:>16}")
+    return 1 if dropped else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
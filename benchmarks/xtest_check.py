@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""Check what `XTestWriter` types arrives in a window.
+Start a private Xvfb display, open a window with the input focus and
+type text with `XTestWriter` of `typelines.py`, including shifted
+characters and characters missing from the keyboard layout. The window
+reads the key events back into text on its own X connection, like an
+application would, and the exit status is 1 if the text differs.
+Needs Xvfb and python-xlib (Linux only).
+"""
+
+import argparse
+import contextlib
+import itertools
+import os
+import pathlib
+import select
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+benchdir = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(benchdir.parent))
+
+import typelines
+
+# ASCII with shifted characters, then characters missing from a US
+# layout which are typed with spare keycodes
+check_lines = [
+    'interface GigabitEthernet1/0/1',
+    ' description Uplink-To_CORE! (port #1) {100%}',
+    'username Admin secret "P@ss^w0rd~|&*"',
+    'snmp-server location Zürich, café ½ € αβγ',
+    'banner motd ~ Ünïcödé ÅÆØ ñ ß ~',
+    ]
+
+
+def parse_arguments():
+    """Create command line arguments. Returns a parser object."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--spares',
+        type=int,
+        default=2,
+        metavar='N',
+        help=(
+            'Use only N spare keycodes so they are mapped again while '
+            'typing. (default: %(default)s)'
+            ),
+        )
+    return parser
+
+
+@contextlib.contextmanager
+def xvfb_display(timeout=10):
+    """Start Xvfb on a free display number and yield the display name.
+    Raise OSError if Xvfb is missing or does not start.
+    """
+    xvfb = shutil.which('Xvfb')
+    if not xvfb:
+        raise OSError('Xvfb not found')
+    number = next(
+        n for n in range(99, 1000)
+        if not os.path.exists(f"/tmp/.X{n}-lock")
+        and not os.path.exists(f"/tmp/.X11-unix/X{n}")
+        )
+    process = subprocess.Popen(
+        [xvfb, f":{number}", '-screen', '0', '640x480x24', '-nolisten', 'tcp'],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        )
+    try:
+        deadline = time.perf_counter() + timeout
+        while not os.path.exists(f"/tmp/.X11-unix/X{number}"):
+            if process.poll() is not None or time.perf_counter() > deadline:
+                raise OSError('Xvfb did not start')
+            time.sleep(0.05)
+        yield f":{number}"
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def keysym_char(keysym):
+    """Return the character typed by a keysym, or None (for Shift)."""
+    if keysym == 0xff0d:
+        return '\n'
+    if keysym == 0xff09:
+        return '\t'
+    if 0x20 <= keysym <= 0x7e or 0xa0 <= keysym <= 0xff:
+        return chr(keysym)
+    if keysym & 0xff000000 == 0x01000000:
+        return chr(keysym & 0xffffff)
+    return None
+
+
+class KeyReader:
+    """A window with the input focus which turns the key presses it
+    receives into text on its own thread, following keyboard mapping
+    changes as they arrive.
+    """
+
+    def __init__(self, displayname):
+        import Xlib.display
+        import Xlib.X
+        self.display = Xlib.display.Display(displayname)
+        screen = self.display.screen()
+        self.window = screen.root.create_window(
+            0, 0, 200, 100, 0, screen.root_depth,
+            event_mask=Xlib.X.KeyPressMask | Xlib.X.StructureNotifyMask,
+            )
+        self.window.map()
+        while self.display.next_event().type != Xlib.X.MapNotify:
+            pass
+        self.window.set_input_focus(Xlib.X.RevertToParent, Xlib.X.CurrentTime)
+        self.display.sync()
+        self.chars = []
+        self.last = None
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def read(self):
+        """Thread to read the key events until stopped."""
+        import Xlib.X
+        while not self.stop.is_set():
+            select.select([self.display], [], [], 0.05)
+            for _ in range(self.display.pending_events()):
+                event = self.display.next_event()
+                if event.type == Xlib.X.MappingNotify:
+                    self.display.refresh_keyboard_mapping(event)
+                elif event.type == Xlib.X.KeyPress:
+                    level = 1 if event.state & Xlib.X.ShiftMask else 0
+                    keysym = self.display.keycode_to_keysym(
+                        event.detail, level
+                        )
+                    char = keysym_char(keysym)
+                    if char:
+                        self.chars.append(char)
+                        self.last = time.perf_counter()
+
+    def wait(self, count, timeout=10):
+        """Wait until `count` characters arrived or the timeout expires.
+        Return the text read.
+        """
+        deadline = time.perf_counter() + timeout
+        while len(self.chars) < count and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        return ''.join(self.chars)
+
+    def close(self):
+        """Stop reading and close the window's display."""
+        self.stop.set()
+        self.thread.join()
+        self.display.close()
+
+
+def type_and_read(displayname, lines, spares=None):
+    """Type the lines, each followed by ENTER, into a window on the
+    display. Use only `spares` spare keycodes if given. Return the text
+    read by the window and the seconds from the first key sent to the
+    last key read.
+    """
+    reader = KeyReader(displayname)
+    writer = typelines.XTestWriter(displayname)
+    try:
+        if spares is not None:
+            writer.free = writer.free[:spares]
+        text = ''.join(f"{line}\n" for line in lines)
+        start = time.perf_counter()
+        for line in lines:
+            writer.type(f"{line}\n")
+        received = reader.wait(len(text))
+    finally:
+        writer.close()
+        reader.close()
+    return received, (reader.last or start) - start
+
+
+def differences(expected, received):
+    """Return the lines of `expected` not received the same."""
+    return [
+        (want, got) for want, got in itertools.zip_longest(
+            expected.split('\n'), received.split('\n')
+            )
+        if want != got
+        ]
+
+
+def main():
+    """Type the check lines on a private display and compare them."""
+    args = parse_arguments().parse_args()
+    expected = ''.join(f"{line}\n" for line in check_lines)
+    try:
+        with xvfb_display() as displayname:
+            received, seconds = type_and_read(
+                displayname, check_lines, args.spares
+                )
+    except (OSError, ImportError) as e:
+        print(f"Cannot run the XTest check: {e}")
+        return 2
+    wrong = differences(expected, received)
+    for want, got in wrong:
+        print(f"expected {want!r}\n     got {got!r}")
+    print(
+        f"{len(expected)} characters typed in {seconds * 1000:.1f} ms, "
+        f"{len(wrong)} lines differ"
+        )
+    return 1 if wrong else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,18 +12,36 @@ __date__ = '2025-01-23'
 __author__ = 'Todd Wintermute'
 
 import argparse
+import array
+import bisect
+import cProfile
+import collections
+import collections.abc
+import concurrent.futures
+import csv
+import difflib
+import functools
+import gzip
+import io
+import itertools
+import json
 import os
 import pathlib
+import pstats
 import queue
 import re
 import shutil
+import sqlite3
+import string
 import sys
+import tempfile
 import threading
 import time
 import tkinter as tk
 import tkinter.filedialog
 import tkinter.messagebox
 import tkinter.ttk as ttk
+import tracemalloc
 
 # 3rd party module
 import pyperclip
@@ -31,15 +49,74 @@ import pyperclip
 # Built-in modules imported at a later time (Linux only using uinput)
 # select
 
+# Built-in modules imported at a later time (Linux only using inotify)
+# ctypes, select, struct
+
+# Built-in modules imported at a later time (Linux and macOS serial output)
+# select, termios, tty
+
 # 3rd party modules imported at a later time
 # pynput
 
 # 3rd party modules imported at a later time (Linux only):
-# evdev
+# evdev, Xlib (python-xlib, installed with pynput)
 
 # 3rd party modules imported at a later time (macOS only):
 # Quartz
 
+# Stages of the keypress -> type pipeline with rolling timing samples
+perf_stages = (
+    'dispatch',
+    'queue_wait',
+    'press_to_first_char',
+    'chars_per_second',
+    )
+
+# Windows key down and key up messages seen by `win32_event_filter`
+win32_key_messages = frozenset((0x0100, 0x0101))
+
+# Macro key lookup tables for the keyboard hooks, built by
+# `update_macro_keys` so the hooks do not allocate on every key event
+macro_vks = frozenset()
+macro_actions = {}
+
+# Variables whose values are redacted from the transcript
+masked_var_names = re.compile(r'pass|secret|key|token|community', re.I)
+
+# Typed lines waiting for the transcript writer, see `init_transcript`
+transcript_ring = None
+transcript_thread = None
+
+# Key events seen by the listener, see `init_event_trace`
+event_trace = None
+event_tracefile = None
+
+# Parsed template files by path, see `parse_fragment`
+fragment_cache = {}
+
+# Writers used by the controller thread instead of the keyboard
+# controller, set when the program starts
+serial_writer = None
+xtest_writer = None
+
+# Database of the templates compiled by `lint`, set when the program
+# starts (None when templates are only read from their files)
+compiled_file = None
+
+# cProfile profilers by section, populated by `init_profiling`
+profilers = {}
+profile_state = threading.local()
+
+# Memory snapshots taken around imports, a list when `init_profiling`
+# traces memory
+tracemalloc_snapshots = None
+
+
+def typelines_dir():
+    """Return the directory for the files Type Lines keeps between runs."""
+    return pathlib.Path.home() / '.typelines'
+
+
 def parse_arguments():
     """Create command line arguments. Returns a parser object."""
     parser = argparse.ArgumentParser(
@@ -80,36 +157,346 @@ def parse_arguments():
             'Can be with or without variables'
             ),
         )
+    parser.add_argument(
+        '--perf-log',
+        type=pathlib.Path,
+        metavar='FILE',
+        help=(
+            '(Optional) Append a JSON line with the timing of each typed '
+            'line to FILE.'
+            ),
+        )
+    parser.add_argument(
+        '--serial',
+        metavar='DEVICE',
+        help=(
+            '(Optional, Linux and macOS only) Send the lines to the serial '
+            'console DEVICE instead of typing them, ending each with ENTER.'
+            ),
+        )
+    parser.add_argument(
+        '--baud',
+        type=int,
+        default=9600,
+        help='Baud rate of the --serial device. (default: %(default)s)',
+        )
+    parser.add_argument(
+        '--flow',
+        choices=['xonxoff', 'rtscts', 'none'],
+        default='xonxoff',
+        help=(
+            'Flow control of the --serial device, software (XON/XOFF), '
+            'hardware (RTS/CTS), or none. (default: %(default)s)'
+            ),
+        )
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=16,
+        metavar='BYTES',
+        help=(
+            'Send the lines to the --serial device in chunks of at most '
+            'BYTES, no more than a quarter of the device input buffer. '
+            '(default: %(default)s)'
+            ),
+        )
+    parser.add_argument(
+        '--xtest',
+        action='store_true',
+        help=(
+            '(Linux xorg backend only, experimental) Send each line to '
+            'the X server at once with XTest instead of typing with the '
+            'pynput keyboard controller.'
+            ),
+        )
+    parser.add_argument(
+        '--transcript',
+        type=pathlib.Path,
+        metavar='DIR',
+        help=(
+            '(Optional) Keep a transcript of every typed line in rotating '
+            'JSON lines files in DIR. Values of variables with pass, '
+            'secret, key, token, or community in the name are redacted.'
+            ),
+        )
+    parser.add_argument(
+        '--clipboard-size',
+        type=int,
+        default=100,
+        metavar='N',
+        help=(
+            'Number of texts kept in the clipboard history while the '
+            'clipboard is hooked. (default: %(default)s)'
+            ),
+        )
+    parser.add_argument(
+        '--clipboard-bytes',
+        type=int,
+        default=2**20,
+        metavar='BYTES',
+        help=(
+            'Total size of the texts kept in the clipboard history. Larger '
+            'texts are not kept. (default: %(default)s)'
+            ),
+        )
+    parser.add_argument(
+        '--clipboard-filter',
+        default=r'\A.*\Z',
+        metavar='REGEX',
+        help=(
+            'Copied texts matching REGEX are added to the list right away, '
+            'the others only to the clipboard history. '
+            '(default: texts of one line)'
+            ),
+        )
+    parser.add_argument(
+        '--record-events',
+        type=pathlib.Path,
+        metavar='FILE',
+        help=(
+            '(Optional) Record the key events the keyboard listener sees '
+            'and write them to FILE on exit, to replay with '
+            'benchmarks/replay_events.py.'
+            ),
+        )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help=(
+            '(Optional) Profile startup, import, render, typing, and the '
+            'clipboard hook with cProfile.'
+            ),
+        )
+    parser.add_argument(
+        '--tracemalloc',
+        action='store_true',
+        help='(Optional) Save memory allocation snapshots around imports.',
+        )
+    parser.add_argument(
+        '--profile-dir',
+        type=pathlib.Path,
+        default=pathlib.Path('typelines-profile'),
+        metavar='DIR',
+        help=(
+            'Directory for the --profile and --tracemalloc reports. '
+            'Reports are written on exit or from the Help menu. '
+            '(default: %(default)s)'
+            ),
+        )
+    parser.add_argument(
+        '--session',
+        type=pathlib.Path,
+        default=typelines_dir() / 'session.sqlite3',
+        metavar='FILE',
+        help=(
+            'File where the list, position, options, and macro keys are '
+            'saved as they change and restored at start. '
+            '(default: %(default)s)'
+            ),
+        )
+    parser.add_argument(
+        '--no-session',
+        action='store_true',
+        help='Do not save or restore the session.',
+        )
+    parser.add_argument(
+        '--cache',
+        type=pathlib.Path,
+        default=typelines_dir() / 'compiled.sqlite3',
+        metavar='FILE',
+        help=(
+            'File of the templates compiled by `lint --cache FILE` to '
+            'import them from. (default: %(default)s)'
+            ),
+        )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Always read imported templates from their files.',
+        )
+    parser.add_argument(
+        '--templates-dir',
+        type=pathlib.Path,
+        metavar='DIR',
+        help=(
+            '(Optional) Directory of templates to index and search with '
+            'File > Template library.'
+            ),
+        )
+    parser.add_argument(
+        '--inventory',
+        type=pathlib.Path,
+        metavar='FILE',
+        help=(
+            '(Optional) CSV, JSON, or SQLite file of variable values keyed '
+            'by its first column, to fill in the variables of a template '
+            'when a key value is chosen.'
+            ),
+        )
+    return parser
+
+
+def parse_lint_arguments():
+    """Create the `lint` command arguments. Returns a parser object."""
+    parser = argparse.ArgumentParser(
+        prog=f"{pathlib.Path(sys.argv[0]).name} lint",
+        description=(
+            'Check every .txt template in a directory and its subfolders '
+            'for unknown placeholders, unused variables, bad format specs, '
+            'and include errors, and save the compiled templates so they '
+            'import faster.'
+            ),
+        )
+    parser.add_argument(
+        'directory',
+        type=pathlib.Path,
+        help='Directory of templates to check.',
+        )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        metavar='N',
+        help='Number of processes to use. (default: the number of CPUs)',
+        )
+    parser.add_argument(
+        '--cache',
+        type=pathlib.Path,
+        default=typelines_dir() / 'compiled.sqlite3',
+        metavar='FILE',
+        help='File to save the compiled templates to. (default: %(default)s)',
+        )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Only check the templates, do not save them.',
+        )
     return parser
 
 
+def profiled(section):
+    """Decorator to profile a function as `section` when enabled."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if section in profilers or (
+                    section == 'import'
+                    and tracemalloc_snapshots is not None
+                    and tracemalloc.is_tracing()):
+                return run_profiled(section, function, *args, **kwargs)
+            return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def run_profiled(section, function, *args, **kwargs):
+    """Call a function with the profiler of `section` enabled, if any,
+    and take memory snapshots around imports while tracing memory.
+    Nested sections on the same thread are counted in the outer section.
+    """
+    if getattr(profile_state, 'active', None):
+        return function(*args, **kwargs)
+    snapshot = None
+    if (section == 'import' and tracemalloc_snapshots is not None
+            and tracemalloc.is_tracing()):
+        snapshot = tracemalloc.take_snapshot()
+    profiler = profilers.get(section)
+    if profiler:
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is running on a different thread (3.12+)
+            profiler = None
+    profile_state.active = section
+    try:
+        return function(*args, **kwargs)
+    finally:
+        if profiler:
+            profiler.disable()
+        profile_state.active = None
+        if snapshot:
+            tracemalloc_snapshots.append(
+                (snapshot, tracemalloc.take_snapshot())
+                )
+
+
+def init_profiling(profile, trace_memory, profile_dir):
+    """Create the profilers and start tracing memory if requested."""
+    global profile_directory
+    global tracemalloc_snapshots
+    profile_directory = profile_dir
+    tracemalloc_snapshots = []
+    if profile:
+        for section in ('startup', 'import', 'render', 'typing', 'clipboard'):
+            profilers[section] = cProfile.Profile()
+    if trace_memory:
+        tracemalloc.start(10)
+
+
+def write_profile_reports():
+    """Write the cProfile and tracemalloc reports to the directory."""
+    if not profilers and not tracemalloc_snapshots:
+        return False
+    profile_directory.mkdir(parents=True, exist_ok=True)
+    for section, profiler in profilers.items():
+        try:
+            stats = pstats.Stats(profiler)
+        except TypeError:
+            # Nothing was profiled in this section
+            continue
+        stats.dump_stats(profile_directory / f"{section}.prof")
+        with open(profile_directory / f"{section}.txt", 'w') as f:
+            stats.stream = f
+            stats.sort_stats('cumulative').print_stats(50)
+    for n, (before, after) in enumerate(tracemalloc_snapshots, 1):
+        with open(profile_directory / f"import-{n}-tracemalloc.txt", 'w') as f:
+            for stat in after.compare_to(before, 'lineno')[:50]:
+                print(stat, file=f)
+    return True
+
+
+def save_profile_reports():
+    """Write the profile reports and tell the user where they are."""
+    if write_profile_reports():
+        title = 'Profile reports'
+        message = f"Reports written to {profile_directory.resolve()}"
+        tkinter.messagebox.showinfo(title=title, message=message)
+
+
+def quit_program():
+    """Write any profile reports and close the program."""
+    write_profile_reports()
+    close_session()
+    close_transcript()
+    write_event_trace()
+    stop_keyboard_controller()
+    root.destroy()
+
+
 def on_press(key):
     """Assigned to the keyboard listener on_press option."""
+    if event_trace is not None:
+        trace_event(True, key)
     if not is_keyboard_hooked:
         return True
-    if key == keyforward:
-        if reversenextbool.get():
-            typeline_gobackward()
-        else:
-            typeline_goforward()
-    elif key == keyrepeat:
-        typeline()
-    elif key == keyselprev:
-        if reversenextbool.get():
-            cycleforward()
-        else:
-            cyclebackward()
-    elif key == keyselnext:
-        if reversenextbool.get():
-            cyclebackward()
-        else:
-            cycleforward()
-    else:
-        pass
+    actions = macro_actions.get(key)
+    if actions:
+        # The list and the listbox belong to the Tk thread
+        root.after(0, run_macro, actions, time.perf_counter())
+
+
+def run_macro(actions, pressed):
+    """Run the action of a macro key pressed at `pressed`, reversed if
+    the reverse option is set. Called on the Tk thread by `on_press`.
+    """
+    global keypress_time
+    keypress_time = pressed
+    actions[reversenextbool.get()]()
 
 
 def on_release(key):
     """Assigned to the keyboard listener on_release option."""
+    if event_trace is not None:
+        trace_event(False, key)
     if not is_keyboard_hooked:
         return True
 
@@ -117,12 +504,10 @@ def on_release(key):
 def win32_event_filter(msg, data):
     """Windows specific function to suppress specific key presses."""
     global listener
-    macro_keys = [keyforward, keyrepeat, keyselprev, keyselnext]
-    vk_macro_keys = [k.value.vk for k in macro_keys]
     if not is_keyboard_hooked:
         listener._suppress = False
         return True
-    elif all([msg in (0x0100, 0x0101), (data.vkCode in vk_macro_keys)]):
+    elif msg in win32_key_messages and data.vkCode in macro_vks:
         # Key Down/Up on macro keys
         listener._suppress = True
     else:
@@ -132,42 +517,620 @@ def win32_event_filter(msg, data):
 
 def darwin_intercept(event_type, event):
     """macOS only. suppress specific function key presses."""
-    key_events = (
-        Quartz.kCGEventKeyDown,  # value = 10
-        Quartz.kCGEventKeyUp,    # value = 11
-        )
+    if not is_keyboard_hooked or event_type not in darwin_key_events:
+        return event
     kb_event_code = Quartz.kCGKeyboardEventKeycode  # value = 9
     event_keycode = Quartz.CGEventGetIntegerValueField(event, kb_event_code)
-    macro_keys = [keyforward, keyrepeat, keyselprev, keyselnext]
-    keycode_macro_keys = [k.value.vk for k in macro_keys]
-    if not is_keyboard_hooked:
-        return event
-    elif event_type in key_events and event_keycode in keycode_macro_keys:
+    if event_keycode in macro_vks:
         # Suppress keyboard macro keys
         return None
     else:
         return event
 
 
+def init_transcript(directory, maxlen=10000):
+    """Start the transcript writer thread if a directory is given."""
+    global transcript_ring
+    global transcript_stop
+    global transcript_thread
+    transcript_ring = None
+    transcript_thread = None
+    if not directory:
+        return False
+    transcript_ring = collections.deque(maxlen=maxlen)
+    transcript_stop = threading.Event()
+    transcript_thread = threading.Thread(
+        target=transcript_worker,
+        args=(directory, transcript_ring, transcript_stop),
+        daemon=True,
+        )
+    transcript_thread.start()
+
+
+def init_event_trace(tracefile, maxlen=100000):
+    """Start recording the key events the listener sees if a file is
+    given. The events are written to the file on exit. Only macro keys
+    are recorded by name, other keys (which may be passwords being
+    typed) only as an event.
+    """
+    global event_trace
+    global event_tracefile
+    event_tracefile = tracefile
+    if tracefile:
+        event_trace = collections.deque(maxlen=maxlen)
+
+
+def trace_event(pressed, key):
+    """Record a key event, keeping the key only if it is a macro key."""
+    if key not in macro_actions:
+        key = None
+    event_trace.append((time.perf_counter(), pressed, key))
+
+
+def key_vk(key):
+    """Return the virtual key code of a pynput key, or None."""
+    return getattr(getattr(key, 'value', key), 'vk', None)
+
+
+def write_event_trace():
+    """Write the recorded key events as JSON lines, after a first line
+    with the macro keys. Times are in seconds from the first event.
+    The key and vk of keys other than macro keys are null.
+    """
+    if event_trace is None:
+        return False
+    macro_keys = {
+        'forward': keyforward,
+        'repeat': keyrepeat,
+        'selprev': keyselprev,
+        'selnext': keyselnext,
+        'nextlist': keynextlist,
+        }
+    events = list(event_trace)
+    start = events[0][0] if events else 0
+    try:
+        with open(event_tracefile, 'w') as tracefile:
+            tracefile.write(json.dumps({'macro_keys': {
+                name: [str(key), key_vk(key)]
+                for name, key in macro_keys.items()
+                }}) + '\n')
+            for timestamp, pressed, key in events:
+                record = {
+                    'time': timestamp - start,
+                    'press': pressed,
+                    'macro': key is not None,
+                    'key': None if key is None else str(key),
+                    'vk': key_vk(key),
+                    }
+                tracefile.write(json.dumps(record) + '\n')
+    except OSError as e:
+        title = 'Key event trace not saved'
+        message = f"Could not write {event_tracefile}\n{e}"
+        tk.messagebox.showwarning(title=title, message=message)
+        return False
+    return True
+
+
+def redact(text, values):
+    """Replace the values of masked variables (such as `password`) in a
+    typed line with asterisks.
+    """
+    for name, value in (values or {}).items():
+        if value and masked_var_names.search(name):
+            text = text.replace(value, '********')
+    return text
+
+
+def rotate_transcript(path, backups=5):
+    """Rename `path` to `path.1`, `path.1` to `path.2` and so on,
+    keeping `backups` old files.
+    """
+    for n in range(backups - 1, 0, -1):
+        older = path.with_name(f"{path.name}.{n}")
+        if older.exists():
+            os.replace(older, path.with_name(f"{path.name}.{n+1}"))
+    os.replace(path, path.with_name(f"{path.name}.1"))
+
+
+def transcript_worker(directory, ring, stop, maxbytes=10*2**20):
+    """Thread writing the transcript ring to `transcript.jsonl` in
+    `directory` once a second, rotating the file at `maxbytes`.
+    Typing only appends to the ring, all the work is done here.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / 'transcript.jsonl'
+    while True:
+        stopping = stop.wait(1)
+        records = []
+        while ring:
+            typed, source, text, duration = ring.popleft()
+            listname, index, values = source or (None, None, None)
+            records.append(json.dumps({
+                'time': typed,
+                'list': listname,
+                'line': None if index is None else index + 1,
+                'text': redact(text, values),
+                'duration': duration,
+                }) + '\n')
+        if records:
+            if path.exists() and path.stat().st_size >= maxbytes:
+                rotate_transcript(path)
+            with open(path, 'a', encoding='utf-8') as transcript:
+                transcript.writelines(records)
+        if stopping:
+            break
+
+
+def close_transcript():
+    """Write the rest of the transcript and stop the writer thread."""
+    if transcript_thread:
+        transcript_stop.set()
+        transcript_thread.join(timeout=10)
+
+
+def init_perf_stats(logfile=None, maxlen=1000):
+    """Create the rolling timing samples for the typing pipeline."""
+    global perf_samples
+    global perf_logfile
+    perf_samples = {
+        stage: collections.deque(maxlen=maxlen) for stage in perf_stages
+        }
+    perf_logfile = None
+    if logfile:
+        perf_logfile = open(logfile, 'a', buffering=1, encoding='utf-8')
+
+
+def record_perf(pressed, queued, dequeued, first, done, chars):
+    """Store the stage timestamps of one typed line (seconds)."""
+    if pressed:
+        perf_samples['dispatch'].append(queued - pressed)
+        perf_samples['press_to_first_char'].append(first - pressed)
+    perf_samples['queue_wait'].append(dequeued - queued)
+    if chars and done > dequeued:
+        perf_samples['chars_per_second'].append(chars / (done - dequeued))
+    if perf_logfile:
+        record = {
+            'time': time.time(),
+            'chars': chars,
+            'dispatch': queued - pressed if pressed else None,
+            'queue_wait': dequeued - queued,
+            'press_to_first_char': first - pressed if pressed else None,
+            'type_duration': done - dequeued,
+            }
+        perf_logfile.write(json.dumps(record) + '\n')
+
+
+def percentile(values, pct):
+    """Return the nearest rank percentile of a sorted sequence."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def perf_summary():
+    """Return p50/p95/p99 of each stage as a dict of dicts."""
+    summary = {}
+    for stage, samples in perf_samples.items():
+        values = sorted(samples)
+        summary[stage] = {
+            'count': len(values),
+            **{f"p{p}": percentile(values, p) for p in (50, 95, 99)},
+            }
+    return summary
+
+
+class SerialWriter:
+    """Send typed lines to a serial console instead of typing them
+    (Linux and macOS only). Each line is sent in chunks no larger than
+    the device's input buffer. With `xonxoff` flow control the XOFF and
+    XON bytes from the device pause and resume sending between chunks,
+    with `rtscts` the serial driver follows the CTS line, waiting up to
+    `timeout` seconds for the device either way. Used by
+    `typequeueditem` in place of the keyboard controller. Problems are
+    passed to `report` (see `report_typing_error`) if given.
+    """
+
+    XON, XOFF = b'\x11', b'\x13'
+
+    def __init__(self, device, baud=9600, flow='xonxoff', chunksize=16,
+                 eol='\r', timeout=10, report=None):
+        import termios
+        import tty
+        self.flow = flow
+        self.chunksize = chunksize
+        self.eol = eol
+        self.timeout = timeout
+        self.report = report
+        # Seconds to send one byte (start bit, 8 data bits and stop bit)
+        self.bytetime = 10 / baud
+        self.paused = False
+        self.sent = 0
+        self.elapsed = 0.0
+        self.xoffs = 0
+        self.xon_timeouts = 0
+        self.cts_timeouts = 0
+        self.fd = os.open(device, os.O_RDWR | os.O_NOCTTY)
+        try:
+            tty.setraw(self.fd)
+            attrs = termios.tcgetattr(self.fd)
+            # Software flow control is done here to count the XOFFs
+            attrs[0] &= ~(termios.IXON | termios.IXOFF | termios.IXANY)
+            attrs[2] |= termios.CLOCAL | termios.CREAD
+            if flow == 'rtscts':
+                attrs[2] |= termios.CRTSCTS
+            else:
+                attrs[2] &= ~termios.CRTSCTS
+            attrs[4] = attrs[5] = getattr(termios, f"B{baud}")
+            termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def read_flow(self, wait):
+        """Read what the device sent for up to `wait` seconds and follow
+        the last XOFF or XON in it.
+        """
+        import select
+        ready, _, _ = select.select([self.fd], [], [], wait)
+        if not ready:
+            return False
+        data = os.read(self.fd, 1024)
+        if data.rfind(self.XOFF) > data.rfind(self.XON):
+            self.paused = True
+            self.xoffs += 1
+        elif self.XON in data:
+            self.paused = False
+        return True
+
+    def write_chunk(self, chunk):
+        """Send one chunk when the device is ready and wait until it has
+        been sent, at the baud rate even when the driver returns early.
+        """
+        if self.flow == 'xonxoff':
+            while self.read_flow(0):
+                pass
+            deadline = time.perf_counter() + self.timeout
+            while self.paused and time.perf_counter() < deadline:
+                self.read_flow(deadline - time.perf_counter())
+            if self.paused:
+                self.xon_timeouts += 1
+                if self.report:
+                    self.report(
+                        f"The serial device sent no XON after "
+                        f"{self.timeout} seconds, sending resumed"
+                        )
+                self.paused = False
+        start = time.perf_counter()
+        size = len(chunk)
+        while chunk:
+            chunk = chunk[os.write(self.fd, chunk):]
+        self.drain()
+        sendtime = start + size * self.bytetime - time.perf_counter()
+        if sendtime > 0:
+            time.sleep(sendtime)
+
+    def drain(self):
+        """Wait until the driver has sent what was written. With `rtscts`
+        the wait ends after `timeout` seconds where the driver tells how
+        much is left to send (Linux), dropping the rest and raising
+        TimeoutError, since the device may never raise CTS.
+        """
+        import fcntl
+        import struct
+        import termios
+        outq = getattr(termios, 'TIOCOUTQ', None)
+        if self.flow != 'rtscts' or outq is None:
+            termios.tcdrain(self.fd)
+            return True
+        deadline = time.perf_counter() + self.timeout
+        while True:
+            left, = struct.unpack(
+                'i', fcntl.ioctl(self.fd, outq, struct.pack('i', 0))
+                )
+            remaining = deadline - time.perf_counter()
+            if not left:
+                return True
+            if remaining <= 0:
+                break
+            time.sleep(min(max(left * self.bytetime, 0.001), remaining))
+        termios.tcflush(self.fd, termios.TCOFLUSH)
+        self.cts_timeouts += 1
+        raise TimeoutError(
+            f"The serial device did not raise CTS for {self.timeout} "
+            f"seconds, the rest of the line was not sent"
+            )
+
+    def type(self, string):
+        """Send a string in chunks of up to `chunksize` bytes. Errors of
+        the device are passed to `report` if given, and the rest of the
+        string is not sent.
+        """
+        start = time.perf_counter()
+        data = string.encode()
+        try:
+            for n in range(0, len(data), self.chunksize):
+                chunk = data[n:n+self.chunksize]
+                self.write_chunk(chunk)
+                self.sent += len(chunk)
+        except OSError as e:
+            if not self.report:
+                raise
+            self.report(f"Could not send to the serial device: {e}")
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def rate(self):
+        """Return the bytes per second achieved so far."""
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def close(self):
+        """Close the serial device."""
+        os.close(self.fd)
+
+
+class XTestWriter:
+    """Type lines on X11 with the XTest extension (Linux xorg backend
+    only). The keycodes of a whole string are looked up in a copy of
+    the keyboard mapping and its key events are sent with one flush,
+    without a round trip to the X server for each key. Characters
+    missing from the keyboard mapping are typed with spare keycodes
+    mapped to them while needed, and restored by `close`. Used by
+    `typequeueditem` in place of the keyboard controller. Characters
+    which cannot be typed are passed to `report` (see
+    `report_typing_error`) if given.
+    """
+
+    eol = ''
+    keysyms_by_char = {'\n': 0xff0d, '\r': 0xff0d, '\t': 0xff09}
+
+    def __init__(self, displayname=None, refresh=1.0, remapdelay=0.05,
+                 report=None):
+        import Xlib.display
+        import Xlib.error
+        import Xlib.XK
+        try:
+            self.display = Xlib.display.Display(displayname)
+        except Xlib.error.DisplayError as e:
+            raise OSError(str(e)) from e
+        if not self.display.has_extension('XTEST'):
+            self.display.close()
+            raise OSError('The X server has no XTEST extension')
+        self.refresh = refresh
+        self.remapdelay = remapdelay
+        self.report = report
+        self.missed = 0
+        self.sent = 0
+        self.elapsed = 0.0
+        self.spares = set()
+        self.read_mapping()
+        self.shift = self.display.keysym_to_keycode(Xlib.XK.XK_Shift_L)
+        # Keycodes without keysyms, free to map to missing characters
+        self.spares = {k for k, v in self.mapping.items() if not any(v)}
+        self.original = {k: self.mapping[k] for k in self.spares}
+        self.free = sorted(self.spares)
+        self.remapped = collections.OrderedDict()  # keysym: keycode
+        self.used = set()  # remapped keycodes already typed
+
+    def read_mapping(self):
+        """Read the keyboard mapping and find the keycode and shift
+        level (0 or 1) of each keysym, other than on spare keycodes.
+        """
+        info = self.display.display.info
+        first = info.min_keycode
+        mapping = self.display.get_keyboard_mapping(
+            first, info.max_keycode - first + 1
+            )
+        self.mapping = {n: tuple(v) for n, v in enumerate(mapping, first)}
+        self.keycodes = {}
+        for keycode, keysyms in self.mapping.items():
+            if keycode in self.spares:
+                continue
+            for level, keysym in enumerate(keysyms[:2]):
+                if keysym and keysym not in self.keycodes:
+                    self.keycodes[keysym] = (keycode, level)
+        self.mapping_time = time.perf_counter()
+
+    def char_keysym(self, char):
+        """Return the keysym of a character."""
+        keysym = self.keysyms_by_char.get(char)
+        if keysym:
+            return keysym
+        code = ord(char)
+        if 0x20 <= code <= 0x7e or 0xa0 <= code <= 0xff:
+            # Latin-1 keysyms are the same as the code points
+            return code
+        return 0x01000000 | code
+
+    def spare_keycode(self, keysym, batch, events):
+        """Return a spare keycode mapped to `keysym`, or None if there
+        are no spare keycodes. A keycode typed in the `batch` of
+        `events` not yet sent is only mapped again after sending them.
+        """
+        keycode = self.remapped.get(keysym)
+        if keycode:
+            self.remapped.move_to_end(keysym)
+            return keycode
+        if not self.free:
+            if not self.remapped:
+                return None
+            oldest = next(
+                (k for k, v in self.remapped.items() if v not in batch),
+                None,
+                )
+            if oldest is None:
+                self.send(events)
+                events.clear()
+                batch.clear()
+                oldest = next(iter(self.remapped))
+            keycode = self.remapped.pop(oldest)
+            if keycode in self.used:
+                # Let the application read the typed key before the
+                # keycode changes meaning
+                self.display.sync()
+                time.sleep(self.remapdelay)
+                self.used.discard(keycode)
+            self.free.append(keycode)
+        keycode = self.free.pop()
+        width = len(self.original[keycode]) or 1
+        self.display.change_keyboard_mapping(keycode, [(keysym,) * width])
+        # Let the application read the new mapping before the keycode
+        # is typed
+        self.display.sync()
+        time.sleep(self.remapdelay)
+        self.remapped[keysym] = keycode
+        return keycode
+
+    def send(self, events):
+        """Send the (event type, keycode) events with one flush."""
+        for event_type, keycode in events:
+            self.display.xtest_fake_input(event_type, keycode)
+            if keycode in self.spares:
+                self.used.add(keycode)
+        self.display.flush()
+
+    def type(self, string):
+        """Type a string, sending all of its key events at once. Errors
+        of the X connection are passed to `report` if given.
+        """
+        import Xlib.error
+        try:
+            self.type_events(string)
+        except (Xlib.error.XError, Xlib.error.ConnectionClosedError,
+                OSError) as e:
+            if not self.report:
+                raise
+            self.report(f"Could not type with XTest: {e}")
+
+    def type_events(self, string):
+        """Send the key events of a string and report missing characters."""
+        import Xlib.X
+        start = time.perf_counter()
+        if start - self.mapping_time > self.refresh:
+            # Follow keyboard layout changes
+            self.read_mapping()
+        press, release = Xlib.X.KeyPress, Xlib.X.KeyRelease
+        events = []
+        batch = set()
+        missing = []
+        for char in string:
+            keysym = self.char_keysym(char)
+            keycode, level = self.keycodes.get(keysym, (None, 0))
+            if keycode is None or (level and not self.shift):
+                keycode = self.spare_keycode(keysym, batch, events)
+                level = 0
+                if keycode is None:
+                    missing.append(char)
+                    continue
+            batch.add(keycode)
+            if level:
+                events.append((press, self.shift))
+            events.extend(((press, keycode), (release, keycode)))
+            if level:
+                events.append((release, self.shift))
+        self.send(events)
+        self.sent += len(string)
+        self.elapsed += time.perf_counter() - start
+        if missing:
+            self.missed += len(missing)
+            if self.report:
+                self.report(
+                    f"Cannot type {''.join(missing)!r}, the keyboard "
+                    f"mapping has no spare keys for them"
+                    )
+
+    def rate(self):
+        """Return the characters per second achieved so far."""
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def close(self):
+        """Restore the spare keycodes and close the display. Called on the
+        thread typing with the writer, see `stop_keyboard_controller`.
+        """
+        import Xlib.error
+        try:
+            for keycode in self.remapped.values():
+                keysyms = self.original[keycode] or (0,)
+                self.display.change_keyboard_mapping(keycode, [keysyms])
+            self.display.close()
+        except (Xlib.error.XError, Xlib.error.ConnectionClosedError,
+                OSError):
+            # Closing anyway, the X connection may already be gone
+            pass
+
+
+@profiled('typing')
+def typequeueditem(keyboard_controller, item, eol=''):
+    """Type one queued item and record the time spent in each stage.
+    The item ends with the list name, line index and variable values of
+    the line for the transcript, or None. `eol` is sent after the line.
+    """
+    curseltxt, pressed, queued, source = item
+    dequeued = time.perf_counter()
+    keyboard_controller.type(curseltxt[:1])
+    first = time.perf_counter()
+    keyboard_controller.type(curseltxt[1:] + eol)
+    done = time.perf_counter()
+    record_perf(pressed, queued, dequeued, first, done, len(curseltxt))
+    if transcript_ring is not None:
+        typed = (time.time(), source, curseltxt, done - dequeued)
+        transcript_ring.append(typed)
+
+
+def report_typing_error(message):
+    """Show a problem found while typing on the controller thread as a
+    warning, from the Tk thread.
+    """
+    root.after(0, show_typing_error, message)
+
+
+def show_typing_error(message):
+    """Warn about a typing problem, see `report_typing_error`."""
+    searchstatus.set('Typing problem')
+    title = 'Typing problem'
+    tk.messagebox.showwarning(title=title, message=message)
+
+
 def controller_worker():
-    """Thread for the keyboard controller to type lines."""
-    keyboard_controller = pynput.keyboard.Controller()
+    """Thread for the keyboard controller (or serial writer) to type
+    lines.
+    """
+    if serial_writer:
+        keyboard_controller = serial_writer
+        eol = serial_writer.eol
+    elif xtest_writer:
+        keyboard_controller = xtest_writer
+        eol = ''
+    else:
+        keyboard_controller = pynput.keyboard.Controller()
+        eol = ''
     while True:
-        time.sleep(100/1000)
-        if not keyboard_queue.empty():
-            curseltxt = keyboard_queue.get()
-            keyboard_controller.type(curseltxt)
+        item = keyboard_queue.get()
+        if item is None:
+            # Closed on this thread so it is not in use while closing
+            if xtest_writer:
+                xtest_writer.close()
             keyboard_queue.task_done()
+            return
+        typequeueditem(keyboard_controller, item, eol)
+        keyboard_queue.task_done()
 
 
 def typeline():
     """Type the current selected line and copy value to clipboard."""
-    try:
-        curseltxt = listbox.get(listbox.curselection())
-        keyboard_queue.put(curseltxt)
-        copy_item()
-    except:
+    global keypress_time
+    pressed, keypress_time = keypress_time, None
+    curpos = current_position()
+    if curpos is None:
         warning_no_selection()
+        return False
+    curseltxt = listlines[curpos]
+    source = None
+    if transcript_ring is not None:
+        values = current_template['values'] if current_template else None
+        source = (list_name(active_list), curpos, values)
+    keyboard_queue.put((curseltxt, pressed, time.perf_counter(), source))
+    pyperclip.copy(curseltxt)
 
 
 def typeline_goforward():
@@ -183,16 +1146,33 @@ def typeline_gobackward():
 
 
 def update_macro_keys():
-    """Reset selection and focus when macro keys are changed."""
+    """Reset selection and focus when macro keys are changed and
+    rebuild the lookup tables used by the keyboard hooks.
+    """
     global keyforward
     global keyrepeat
     global keyselprev
     global keyselnext
+    global keynextlist
+    global macro_vks
+    global macro_actions
     keyforward = Key[keydict[forward.get()]]
     keyrepeat = Key[keydict[repeat.get()]]
     keyselprev = Key[keydict[selprev.get()]]
     keyselnext = Key[keydict[selnext.get()]]
-    curpos = listbox.curselection()[-1] or 0
+    keynextlist = Key[keydict[nextlist.get()]]
+    # Actions when not reversed and reversed. The first macro wins if
+    # the same key is chosen twice, so it is added last.
+    macro_table = [
+        (keynextlist, (next_list, next_list)),
+        (keyselnext, (cycleforward, cyclebackward)),
+        (keyselprev, (cyclebackward, cycleforward)),
+        (keyrepeat, (typeline, typeline)),
+        (keyforward, (typeline_goforward, typeline_gobackward)),
+        ]
+    macro_actions = dict(macro_table)
+    macro_vks = frozenset(key.value.vk for key, _ in macro_table)
+    curpos = current_position() or 0
     mygui.selection_clear()
     set_listbox_selection(curpos)
 
@@ -202,8 +1182,8 @@ def hookclipboard():
     global hookcbid
     global lastcbvalue
     if hookcb.get():
-        lastcbvalue = ''
-        pyperclip.copy('')
+        # Only text copied from now on is captured
+        lastcbvalue = pyperclip.paste()
         checkcb()
     else:
         if hookcbid:
@@ -213,8 +1193,8 @@ def hookclipboard():
 
 def edititem(text, pos):
     """Edit selected list item."""
-    listbox.insert(pos+1, text)
-    listbox.delete(pos)
+    list_delete(pos)
+    list_insert(pos, [text])
     listbox.select_clear(pos)
     listbox.select_set(pos)
 
@@ -226,9 +1206,10 @@ def submit_edit_item(child, text, pos):
 
 
 def copy_item():
-    """Copy selected item to the system clipboard."""
-    if listbox.curselection():
-        pyperclip.copy(listbox.get(listbox.curselection()))
+    """Copy the selected items to the system clipboard."""
+    selected = current_selection()
+    if selected:
+        pyperclip.copy('\n'.join(listlines[row] for row in selected))
         return True
     else:
         warning_no_selection()
@@ -263,11 +1244,11 @@ def warning_no_selection():
 
 def edit_item_window():
     """Child window to modify a line."""
-    if not listbox.curselection():
+    curpos = current_position()
+    if curpos is None:
         warning_no_selection()
         return False
-    curpos, *_ = listbox.curselection()
-    curtext = listbox.get(curpos)
+    curtext = listlines[curpos]
     myedit = tk.Toplevel(root)
     myedit.title('Edit item')
     mychild = ttk.Frame(myedit, padding=(2,2,2,2))
@@ -301,10 +1282,15 @@ def edit_item_window():
 
 
 def additem(element):
-    """Add a new item to the list."""
-    for line in [line for line in element.splitlines()]:
-        listbox.insert('end', line)
-    removeblanklines()
+    """Add new items to the end of the list."""
+    lines = element.splitlines()
+    if allowblankline.get():
+        list_insert(len(listlines), lines)
+    else:
+        list_remove(blank_rows(listlines[:]))
+        list_insert(len(listlines), strip_blank_lines(lines))
+        if not listlines:
+            list_insert(0, [''])
 
 
 def insert_item_before_window():
@@ -369,97 +1355,130 @@ def submit_insert_item_after(child, text):
 
 def insert_item_before(text):
     """Insert an item before the selected line."""
-    if listbox.curselection():
-        curpos, *_ = listbox.curselection()
-        if curpos == 0:
-            newpos = 0
-            curpos = 1
-        else:
-            newpos = curpos
-            curpos = curpos + 1
-    else:
+    curpos = current_position()
+    if curpos is None:
         warning_no_selection()
         return False
-    listbox.insert(newpos, text)
-    listbox.select_clear(curpos)
-    listbox.select_set(newpos)
+    list_insert(curpos, [text])
+    listbox.select_clear(curpos + 1)
+    listbox.select_set(curpos)
 
 
 def insert_item_after(text):
     """Insert an item after the selected line."""
-    if listbox.curselection():
-        curpos, *_ = listbox.curselection()
-        newpos = curpos + 1
-    else:
+    curpos = current_position()
+    if curpos is None:
         warning_no_selection()
         return False
-    listbox.insert(newpos, text)
+    newpos = curpos + 1
+    list_insert(newpos, [text])
     listbox.select_clear(curpos)
     listbox.select_set(newpos)
 
 
 def removeitem():
-    """Remove the selected line from the list."""
-    if listbox.curselection():
-        selected = listbox.curselection()
-        # Remove multiple rows (currently select multiple not enabled)
-        if len(selected) > 1:
-            for row in selected[::-1]:
-                listbox.delete(row)
-            return True
-        curpos = listbox.curselection()[0]
-        old_end = listbox.size() - 1
-        listbox.delete(listbox.curselection())
-        new_end = listbox.size() - 1
-        if curpos < new_end:
-            set_listbox_selection(curpos)
-        elif curpos >= new_end:
-            set_listbox_selection(new_end)
-        else:
-            set_listbox_selection(0)
-    else:
+    """Remove the selected lines from the list."""
+    selected = current_selection()
+    if not selected:
         warning_no_selection()
         return False
-    if not listbox.size():
-        listbox.insert(0, '')
-        set_listbox_selection(0)
+    if len(selected) == 1 or is_contiguous(selected):
+        list_delete(selected[0], selected[-1])
+    else:
+        list_remove(selected)
+    if not listlines:
+        list_insert(0, [''])
+    set_listbox_selection(min(selected[0], len(listlines) - 1))
 
 
 def clearclipboard():
     """Remove all lines from the list."""
-    listbox.delete(0, 'end')
-    listbox.insert(0, '')
+    list_replace([''])
     set_listbox_selection(0)
 
 
 def moveitemup():
-    """Move the selected line up one."""
-    curpos, *_ = listbox.curselection()
-    if isinstance(curpos, int) and curpos > 0:
-        curtext = listbox.get(curpos)
-        uppos = curpos - 1
-        uptext = listbox.get(uppos)
-        listbox.delete(uppos)
-        listbox.insert(uppos, curtext)
-        listbox.delete(curpos)
-        listbox.insert(curpos, uptext)
-        listbox.select_set(uppos)
-        listbox.see(uppos)
+    """Move the selected lines up one."""
+    moveitems(-1)
 
 
 def moveitemdown():
-    """Move the selected line down one."""
-    curpos, *_ = listbox.curselection()
-    if isinstance(curpos, int) and curpos < (listbox.index('end') - 1):
-        curtext = listbox.get(curpos)
-        downpos = curpos + 1
-        downtext = listbox.get(downpos)
-        listbox.delete(downpos)
-        listbox.insert(downpos, curtext)
-        listbox.delete(curpos)
-        listbox.insert(curpos, downtext)
-        listbox.select_set(downpos)
-        listbox.see(downpos)
+    """Move the selected lines down one."""
+    moveitems(1)
+
+
+def moveitems(offset):
+    """Move the selected lines up (-1) or down (1) as one block."""
+    selected = current_selection()
+    if not selected:
+        warning_no_selection()
+        return False
+    first, last = selected[0], selected[-1]
+    if first + offset < 0 or last + offset >= len(listlines):
+        return False
+    if is_contiguous(selected):
+        # Move the neighboring line to the other side of the block
+        if offset < 0:
+            neighbor = listlines[first - 1]
+            list_delete(first - 1)
+            list_insert(last, [neighbor])
+        else:
+            neighbor = listlines[last + 1]
+            list_delete(last + 1)
+            list_insert(first, [neighbor])
+        newrows = [row + offset for row in selected]
+    else:
+        newlines, newrows = move_rows(listlines, selected, offset)
+        list_replace(newlines)
+    select_rows(newrows)
+
+
+def duplicateitems():
+    """Insert a copy of the selected lines after the selection."""
+    selected = current_selection()
+    if not selected:
+        warning_no_selection()
+        return False
+    block = [listlines[row] for row in selected]
+    list_insert(selected[-1] + 1, block)
+    select_rows(range(selected[-1] + 1, selected[-1] + 1 + len(block)))
+
+
+def sortitems():
+    """Sort the selected lines, or the whole list if one is selected."""
+    selected = current_selection()
+    if len(selected) > 1:
+        transform = functools.partial(sort_rows, rows=selected)
+        list_replace(transform(listlines), {'apply': transform})
+        select_rows(selected)
+    else:
+        list_replace(sorted(listlines), {'apply': sorted})
+        set_listbox_selection(0)
+
+
+def dedupeitems():
+    """Remove repeated lines keeping the first occurrence."""
+    curpos = current_position() or 0
+    list_remove(repeated_rows(listlines[:]))
+    set_listbox_selection(min(curpos, len(listlines) - 1))
+
+
+def stripblanklines():
+    """Remove the blank lines now, whether or not they are allowed."""
+    curpos = current_position() or 0
+    rows = blank_rows(listlines[:])
+    if len(rows) == len(listlines):
+        # Keep one blank line in a list of blank lines
+        rows = rows[1:]
+    if rows:
+        list_remove(rows)
+        set_listbox_selection(min(curpos, len(listlines) - 1))
+
+
+def selectallitems():
+    """Select every line in the list."""
+    refresh_listbox()
+    listbox.selection_set(0, 'end')
 
 
 def do_rightclickmenu(event):
@@ -473,46 +1492,345 @@ def childdismiss(child):
     child.destroy()
 
 
-def updatechildcombo(child, text, varsdict, myvarscmbs2):
-    """Substitute the import template keywords from variables."""
-    selectedvarsdict = {k: v.get() for k,v in zip(varsdict, myvarscmbs2)}
-    fmttextlist = [
+def parse_template_vars(text):
+    """Return a dict of the `##var:` names and their default values."""
+    # Search for variables in the import file
+    # It is valid to have only a variable name and no values
+    varsregex = re.compile(r'^## ?var:(?P<name>[^:=]+)[:=]?(?P<values>.*)?')
+    varsmatch = [varsregex.match(t) for t in text.splitlines()]
+    varsdict = {
+        m['name'].strip(): m['values'].strip() if m['values'] else ''
+        for m in varsmatch
+        if m and m['name'] #and m['values']
+        }
+    varsdict = {
+        k: [v] if generator_values(v) is not None
+        else [v.strip() or '' for v in v.split(',') ] #if v]
+        for k,v in varsdict.items()
+        }
+    return varsdict
+
+
+def generator_values(value):
+    """Return the values of a generator variable or None.
+    `range(start, stop[, step])` counts like Python's range and
+    `each(a, b, c)` lists the values to use one after another.
+    """
+    m = re.match(r'^\s*(range|each)\((.*)\)\s*$', value)
+    if not m:
+        return None
+    kind, args = m.groups()
+    parts = [a.strip() for a in args.split(',')]
+    if kind == 'each':
+        return parts
+    try:
+        return [str(n) for n in range(*[int(a) for a in parts])]
+    except (ValueError, TypeError):
+        return None
+
+
+def render_template(text, selectedvarsdict):
+    """Return the template lines with the keywords substituted."""
+    return [
         x.format_map(selectedvarsdict) for x in text.splitlines()
         if not re.match(r'^[#;][^ a-zA-Z0-9]', x)
         ]
-    listbox_text.set(fmttextlist)
-    removeblanklines()
-    set_listbox_selection(0)
-    curline = listbox.get(listbox.curselection())
-    if skipcommentlines.get() and re.match(r'^#', curline):
-        if reversenextbool.get():
-            cyclebackward()
+
+
+def filter_import_lines(text):
+    """Return the lines of a file without variables that are imported."""
+    textlist = text.splitlines()
+    return [x for x in textlist if not re.match(r'^#[^ a-zA-Z0-9]',x)]
+
+
+def strip_blank_lines(lines):
+    """Return the lines which are not blank."""
+    return [x for x in lines if x]
+
+
+def next_position(iscomment, size, curpos, step=1, skipcomments=False):
+    """Return the position `step` lines away, wrapping around the ends.
+    If `skipcomments` is set keep moving until `iscomment` of a position
+    is false (see `LineStore.comment_flags`). A list of only comment
+    lines stops after the first step.
+    """
+    newpos = (curpos + step) % size
+    if skipcomments:
+        for _ in range(size):
+            if not iscomment(newpos):
+                break
+            newpos = (newpos + step) % size
         else:
-            cycleforward()
+            newpos = (curpos + step) % size
+    return newpos
+
+
+def is_contiguous(rows):
+    """Return True if the sorted rows have no gaps."""
+    return rows[-1] - rows[0] == len(rows) - 1
+
+
+def delete_rows(lines, rows):
+    """Return the lines without the given rows."""
+    rows = set(rows)
+    return [x for n, x in enumerate(lines) if n not in rows]
+
+
+def restore_rows(lines, rows, removed):
+    """Return the lines with the `removed` lines put back at the sorted
+    rows they were removed from (the reverse of `delete_rows`).
+    """
+    newlines = []
+    rest = iter(lines)
+    for row, line in zip(rows, removed):
+        newlines.extend(itertools.islice(rest, row - len(newlines)))
+        newlines.append(line)
+    newlines.extend(rest)
+    return newlines
+
+
+def blank_rows(lines):
+    """Return the rows of the blank lines."""
+    return [n for n, x in enumerate(lines) if not x]
+
+
+def repeated_rows(lines):
+    """Return the rows of the lines seen before in the list."""
+    seen = set()
+    rows = []
+    for n, x in enumerate(lines):
+        if x in seen:
+            rows.append(n)
+        else:
+            seen.add(x)
+    return rows
+
+
+def move_rows(lines, rows, offset):
+    """Move each of the sorted rows by `offset` (-1 or 1) past the
+    neighboring unselected line. Return the new lines and rows.
+    """
+    newlines = list(lines)
+    order = rows if offset < 0 else rows[::-1]
+    newrows = []
+    for row in order:
+        newrow = row + offset
+        if 0 <= newrow < len(newlines) and newrow not in newrows:
+            newlines[row], newlines[newrow] = newlines[newrow], newlines[row]
+        else:
+            newrow = row
+        newrows.append(newrow)
+    return newlines, sorted(newrows)
+
+
+def sort_rows(lines, rows):
+    """Return the lines with only the given rows sorted among themselves."""
+    newlines = list(lines)
+    for row, line in zip(rows, sorted(lines[row] for row in rows)):
+        newlines[row] = line
+    return newlines
+
+
+def importable_lines(lines, allowblank):
+    """Return imported lines without blank lines unless they are allowed."""
+    if allowblank:
+        return lines
+    return strip_blank_lines(lines) or ['']
+
+
+def template_blocks(body, values, generators):
+    """Yield the template body rendered once for each combination of
+    the generator variable values, without rendering ahead.
+    """
+    for combination in itertools.product(*generators.values()):
+        blockvalues = {**values, **dict(zip(generators, combination))}
+        yield [x.format_map(blockvalues) for x in body]
+
+
+def render_lines(text, values, allowblank):
+    """Render a template for the list (`values` is None for a file
+    without variables). Return the lines and an iterator of the blocks
+    still to be added for generator variables, or None.
+    """
+    if values is None:
+        return importable_lines(filter_import_lines(text), allowblank), None
+    generators = {
+        k: v for k, v in
+        ((k, generator_values(v)) for k, v in values.items())
+        if v is not None
+        }
+    if not generators:
+        lines = render_template(text, values)
+        return importable_lines(lines, allowblank), None
+    body = [
+        x for x in text.splitlines()
+        if not re.match(r'^[#;][^ a-zA-Z0-9]', x)
+        ]
+    blocks = template_blocks(body, values, generators)
+    return importable_lines(next(blocks, []), allowblank), blocks
+
+
+class LazyBlocks:
+    """The generated blocks of a template render not yet added to the
+    list. Each block taken is counted in the render recipe, so that
+    `materialize` renders the list again as far as it was expanded.
+    """
+
+    def __init__(self, blocks, recipe):
+        self.blocks = blocks
+        self.recipe = recipe
+        self.exhausted = False
+
+    def __bool__(self):
+        return not self.exhausted
+
+    def take(self):
+        """Return the lines of the next block, or None at the end."""
+        block = next(self.blocks, None)
+        if block is None:
+            self.exhausted = True
+            return None
+        self.recipe['expanded'] = self.recipe.get('expanded', 0) + 1
+        if not self.recipe['allowblank']:
+            block = strip_blank_lines(block)
+        return block
+
+
+def render_recipe(recipe):
+    """Render a template recipe with as many generated blocks as were
+    added to the list (its 'expanded' count). Return the lines and the
+    LazyBlocks still to be added, or None.
+    """
+    lines, blocks = render_lines(
+        recipe['render'], recipe['values'], recipe['allowblank']
+        )
+    if blocks is None:
+        return lines, None
+    lazy = LazyBlocks(blocks, recipe)
+    expanded = recipe.get('expanded', 0)
+    recipe['expanded'] = 0
+    lines = list(lines)
+    for _ in range(expanded):
+        block = lazy.take()
+        if block is None:
+            break
+        lines += block
+    return lines, lazy
+
+
+def expanded_blocks():
+    """Return the number of generated blocks added to the list."""
+    if lazy_expansion is None:
+        return 0
+    return lazy_expansion.recipe.get('expanded', 0)
+
+
+def expand_lazy_lines(curpos, lookahead=1):
+    """Add the next generated blocks until there are `lookahead` lines
+    to move to after the selection (not counting skipped comments).
+    """
+    while lazy_expansion and not lines_ahead(curpos, lookahead):
+        block = lazy_expansion.take()
+        if block is None:
+            return False
+        # Counted in the render recipe instead of the undo history, the
+        # recorded changes are before these lines so they still apply
+        list_insert(len(listlines), block, record=False)
+
+
+def expand_all_lazy_lines(size=None):
+    """Add the generated blocks not yet in the list in one insert, all
+    of them or until the list has `size` lines. Used where the whole
+    list is needed, like saving and searching it.
+    """
+    lines = []
+    while lazy_expansion and (
+            size is None or len(listlines) + len(lines) < size):
+        block = lazy_expansion.take()
+        if block is None:
+            break
+        lines += block
+    # Counted in the render recipe like `expand_lazy_lines`
+    list_insert(len(listlines), lines, record=False)
+
+
+def lines_ahead(curpos, wanted):
+    """Return True if there are `wanted` lines to move to after `curpos`."""
+    skipcomments = skipcommentlines.get()
+    comments = listlines.comment_flags()
+    count = 0
+    for n in range(curpos + 1, len(listlines)):
+        if not (skipcomments and comments[n]):
+            count += 1
+            if count >= wanted:
+                return True
+    return False
+
+
+@profiled('render')
+def updatechildcombo(child, text, varsdict, myvarscmbs2, rerender=False,
+                     template=None):
+    """Substitute the import template keywords from variables.
+    With `rerender` only the changed lines are updated and the
+    selection stays on the same line. A newly imported `template`
+    becomes the current template.
+    """
+    global current_template
+    global lazy_expansion
+    global var_table
+    selectedvarsdict = {k: v.get() for k,v in zip(varsdict, myvarscmbs2)}
+    if template:
+        current_template = {**template, 'values': selectedvarsdict}
+        var_table = None
+    elif current_template and current_template['text'] is text:
+        current_template = {**current_template, 'values': selectedvarsdict}
+    allowblank = allowblankline.get()
+    recipe = {
+        'render': text, 'values': selectedvarsdict, 'allowblank': allowblank
+        }
+    if rerender:
+        # Render as many generated blocks as the list has
+        recipe['expanded'] = expanded_blocks()
+    lines, lazy = render_recipe(recipe)
+    if rerender:
+        apply_line_diff(lines, recipe)
+        lazy_expansion = lazy
+    else:
+        list_replace(lines, recipe)
+        lazy_expansion = lazy
+        set_listbox_selection(0)
+        jumpovercommentlines()
     childdismiss(child)
     child.destroy()
     return True
 
 
+@profiled('render')
 def importwithoutvars(text):
     """Import a file and replace the list with its contents."""
-    textlist = text.splitlines()
-    textlist = [x for x in textlist if not re.match(r'^#[^ a-zA-Z0-9]',x)]
-    listbox_text.set(textlist)
-    removeblanklines()
+    textlist = filter_import_lines(text)
+    allowblank = allowblankline.get()
+    list_replace(
+        importable_lines(textlist, allowblank),
+        {'render': text, 'values': None, 'allowblank': allowblank},
+        )
     set_listbox_selection(0)
-    curline = listbox.get(listbox.curselection())
-    if skipcommentlines.get() and re.match(r'^#', curline):
-        if reversenextbool.get():
-            cyclebackward()
-        else:
-            cycleforward()
+    jumpovercommentlines()
 
 
-def importwithvars(text, varsdict):
-    """Import a template and replace the list with its contents."""
+def importwithvars(text, varsdict, prefill=None, template=None):
+    """Import a template and replace the list with its contents.
+    With `prefill` (the previous values) the template is rendered
+    again and only the changed lines are updated. `template` becomes
+    the current template when the values are submitted.
+    """
+    rerender = prefill is not None
+    prefill = prefill or {}
     myvars = tk.Toplevel(root)
-    myvars.title('Import list file with vars')
+    if rerender:
+        myvars.title('Re-render with new values')
+    else:
+        myvars.title('Import list file with vars')
     mychild = ttk.Frame(myvars, padding=(2,2,2,2))
     mychild.grid(column=0, row=0, sticky='NWES')
     myvarslbls1 = []
@@ -533,7 +1851,9 @@ def importwithvars(text, varsdict):
         myvarslbls2.append(ttk.Label(mychild))
         myvarslbls2[-1].config(text=f"{keyss}:")
         myvarslbls2[-1].grid(column=1, row=n, sticky='EN')
-        myvarsstrs2.append(tk.StringVar(value=values[0]))
+        myvarsstrs2.append(
+            tk.StringVar(value=prefill.get(keyss, values[0]))
+            )
         myvarscmbs2.append(ttk.Combobox(mychild, justify='center'))
         myvarscmbs2[-1].config(textvariable=myvarsstrs2[-1])
         myvarscmbs2[-1].config(values=values)
@@ -541,142 +1861,2389 @@ def importwithvars(text, varsdict):
         myvarsents2.append(ttk.Entry(mychild, justify='center'))
         myvarsents2[-1].config(textvariable=myvarsstrs2[-1])
         myvarsents2[-1].grid(column=3, row=n, sticky='WN')
+    fields = dict(zip(varsdict, zip(myvarscmbs2, myvarsstrs2)))
+    traces = []
+    myvarslbls2.append(ttk.Label(mychild))
+    myvarslbls2[-1].config(text='Inventory:')
+    myvarslbls2[-1].grid(column=1, row=n+1, sticky='EN')
+    myvarsents2.append(ttk.Entry(mychild, textvariable=inventoryfile))
+    myvarsents2[-1].config(state='readonly')
+    myvarsents2[-1].grid(column=2, row=n+1, sticky='WEN')
     myvarsbtns1 = []
     myvarsbtns1.append(ttk.Button(mychild))
+    myvarsbtns1[-1].config(text='Browse')
+    myvarsbtns1[-1].config(command=lambda: choose_inventory(
+        myvars, fields, traces
+        ))
+    myvarsbtns1[-1].grid(column=3, row=n+1, sticky='WEN')
+    myvarsbtns1.append(ttk.Button(mychild))
     myvarsbtns1[-1].config(text='Submit')
-    myvarsbtns1[-1].config(
-        command=lambda: updatechildcombo(myvars, text, varsdict, myvarscmbs2)
+    myvarsbtns1[-1].config(command=lambda: updatechildcombo(
+        myvars, text, varsdict, myvarscmbs2, rerender, template
+        ))
+    myvarsbtns1[-1].grid(column=1, columnspan=3, row=n+2, rowspan=3)
+    myvarsbtns1[-1].grid(sticky='EWNS')
+    myvars.bind('<Escape>', lambda event: childdismiss(myvars))
+    myvars.bind('<Return>', lambda event: updatechildcombo(
+        myvars, text, varsdict, myvarscmbs2, rerender, template
+        ))
+    for child in mychild.winfo_children():
+        child.grid_configure(padx=2, pady=2)
+    attach_inventory(fields, traces)
+    myvars.update()
+    myvars.minsize(myvars.winfo_width(), myvars.winfo_height())
+    myvars.maxsize(myvars.winfo_width(), myvars.winfo_height())
+    myvars.grab_set()
+    myvars.focus()
+    myvars.wait_window()
+
+
+def read_inventory(path):
+    """Return the column names and rows of an inventory file, a CSV file
+    with the column names on the first line, a JSON list of objects, or
+    the first table of a SQLite database.
+    """
+    if path.suffix.lower() in ('.sqlite', '.sqlite3', '.db'):
+        uri = f"{path.resolve().as_uri()}?mode=ro"
+        connection = sqlite3.connect(uri, uri=True)
+        try:
+            table = connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' "
+                "ORDER BY rowid LIMIT 1"
+                ).fetchone()
+            if not table:
+                raise ValueError(f"{path} has no tables")
+            name = table[0].replace('"', '""')
+            cursor = connection.execute(f'SELECT * FROM "{name}"')
+            columns = [d[0] for d in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor]
+        finally:
+            connection.close()
+    elif path.suffix.lower() == '.json':
+        rows = json.loads(path.read_text())
+        if not isinstance(rows, list) or not all(
+                isinstance(row, dict) for row in rows
+                ):
+            raise ValueError(f"{path} is not a JSON list of objects")
+        columns = list(rows[0]) if rows else []
+    else:
+        with open(path, newline='') as csvfile:
+            # Short rows get empty values instead of None
+            reader = csv.DictReader(csvfile, restval='')
+            rows = list(reader)
+            columns = reader.fieldnames or []
+    if not columns:
+        raise ValueError(f"{path} has no columns")
+    return columns, rows
+
+
+def load_inventory(path):
+    """Return the index of an inventory file keyed by its first column.
+    The index is built once and reused until the file changes.
+    """
+    signature = file_signature(path)
+    cached = inventory_cache.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    columns, rows = read_inventory(path)
+    key = columns[0]
+    index = {}
+    for row in rows:
+        value = row.get(key)
+        if value is None or value == '':
+            continue
+        index[str(value)] = {
+            k: str(v) for k, v in row.items() if k and v is not None
+            }
+    inventory = {
+        'key': key,
+        'rows': index,
+        'keys': sorted((k.casefold(), k) for k in index),
+        }
+    inventory_cache[path] = (signature, inventory)
+    return inventory
+
+
+def inventory_matches(inventory, prefix, limit=100):
+    """Return up to `limit` key values starting with `prefix`, ignoring
+    case, in sorted order.
+    """
+    keys = inventory['keys']
+    prefix = prefix.casefold()
+    start = bisect.bisect_left(keys, (prefix,))
+    matches = []
+    for folded, key in itertools.islice(keys, start, start + limit):
+        if not folded.startswith(prefix):
+            break
+        matches.append(key)
+    return matches
+
+
+def fill_from_inventory(inventory, fields):
+    """Offer the inventory keys starting with the value of the key
+    variable, and fill the other variables when the value is a key.
+    """
+    combobox, keyvar = fields[inventory['key']]
+    value = keyvar.get()
+    combobox.config(values=inventory_matches(inventory, value))
+    row = inventory['rows'].get(value)
+    if row is None:
+        return False
+    for name, field in row.items():
+        if name != inventory['key'] and name in fields:
+            fields[name][1].set(field)
+    return True
+
+
+def attach_inventory(fields, traces):
+    """Fill the variables in the import dialog from the inventory file
+    when a value of its key variable is chosen or typed. `fields` maps
+    each variable to its combobox and string variable.
+    """
+    for var, traceid in traces:
+        var.trace_remove('write', traceid)
+    traces.clear()
+    filename = inventoryfile.get()
+    if not filename:
+        return False
+    try:
+        inventory = load_inventory(pathlib.Path(filename))
+    except (OSError, ValueError, csv.Error, sqlite3.Error) as e:
+        title = 'Inventory error'
+        message = f"Could not read inventory {filename}\n{e}"
+        tk.messagebox.showwarning(title=title, message=message)
+        return False
+    if inventory['key'] not in fields:
+        title = 'Inventory key not in template'
+        message = (
+            f"The first column of {filename}, {inventory['key']}, "
+            "is not a variable of the template"
+            )
+        tk.messagebox.showwarning(title=title, message=message)
+        return False
+    combobox, keyvar = fields[inventory['key']]
+    combobox.config(values=inventory_matches(inventory, ''))
+    traceid = keyvar.trace_add(
+        'write', lambda *args: fill_from_inventory(inventory, fields)
+        )
+    traces.append((keyvar, traceid))
+    return True
+
+
+def choose_inventory(child, fields, traces):
+    """Ask for the inventory file and attach it to the import dialog."""
+    filename = tkinter.filedialog.askopenfilename(
+        parent=child,
+        filetypes=(
+            ('Inventory file', ('.csv', '.json', '.sqlite', '.db')),
+            ('All files', '*.*'),
+            ),
+        )
+    if filename:
+        inventoryfile.set(filename)
+        attach_inventory(fields, traces)
+
+
+def importfromfile(filename=''):
+    """Import a file and replace the contents of the list."""
+    if not filename:
+        initialdir = pathlib.Path()
+        filename = tkinter.filedialog.askopenfilename(
+            #initialdir=initialdir,  # omit so last location is used
+            defaultextension='.txt',
+            filetypes=(('Text file', '.txt'), ('All files', '*.*'))
+            )
+    if not filename:
+        return False
+    global current_template
+    global var_table
+    importfile = pathlib.Path(filename)
+    if importfile.exists():
+        try:
+            text, varsdict = readtemplate(importfile)
+        except (OSError, ValueError) as e:
+            title = 'Template include error'
+            tk.messagebox.showwarning(title=title, message=str(e))
+            return False
+        template = {
+            'filename': str(importfile.resolve()),
+            'text': text,
+            'varsdict': varsdict,
+            'values': None,
+            }
+    else:
+        title = 'File does not exist'
+        message = f"{importfile} does not exist"
+        tk.messagebox.showwarning(title=title, message=message)
+        return False
+    if varsdict:
+        # Only becomes the current template if the values are submitted
+        importwithvars(text, varsdict, template=template)
+    else:
+        current_template = template
+        var_table = None
+        importwithoutvars(text)
+    if listrecipe and listrecipe['render'] is text:
+        start_watching()
+    else:
+        stop_watching()
+    update_lists_menu()
+
+
+def rerender_template():
+    """Ask for new values for the variables of the imported template,
+    prefilled with the current values, and update the changed lines.
+    The file is not read again.
+    """
+    if not current_template or not current_template['varsdict']:
+        title = 'Nothing to re-render'
+        message = 'Import a template with variables first'
+        tk.messagebox.showwarning(title=title, message=message)
+        return False
+    varsdict = current_template['varsdict']
+    values = template_values(varsdict, current_template['values'])
+    importwithvars(current_template['text'], varsdict, values)
+
+
+def import_var_table():
+    """Read a CSV file with one row of variable values per line (the
+    first line has the variable names) for the imported template and
+    render its first row.
+    """
+    global var_table
+    if not current_template or not current_template['varsdict']:
+        title = 'No template with variables'
+        message = 'Import a template with variables first'
+        tk.messagebox.showwarning(title=title, message=message)
+        return False
+    filename = tkinter.filedialog.askopenfilename(
+        defaultextension='.csv',
+        filetypes=(('CSV file', '.csv'), ('All files', '*.*'))
+        )
+    if not filename:
+        return False
+    try:
+        with open(filename, newline='') as csvfile:
+            rows = list(csv.DictReader(csvfile, restval=''))
+    except (OSError, ValueError, csv.Error) as e:
+        title = 'Variable table error'
+        message = f"Could not read {filename}\n{e}"
+        tk.messagebox.showwarning(title=title, message=message)
+        return False
+    if not rows:
+        title = 'No rows'
+        message = f"{filename} has no rows of variable values"
+        tk.messagebox.showwarning(title=title, message=message)
+        return False
+    var_table = {
+        'rows': rows,
+        'index': None,
+        'rendered': {},
+        'source': None,
+        'generation': 0,
+        }
+    show_table_row(0)
+
+
+def prerender_worker(table, generation, n, text, values, allowblank):
+    """Thread to render a row of the variable table ahead of time.
+    The result, or the error if rendering failed, is tagged with the
+    table generation and dropped if the row is no longer wanted.
+    """
+    try:
+        lines, blocks = render_lines(text, values, allowblank)
+        result = (generation, lines, blocks, LineStore(lines), None)
+    except (KeyError, ValueError, IndexError, AttributeError) as e:
+        result = (generation, None, None, None, e)
+    if table['generation'] == generation and n in table['rendered']:
+        table['rendered'][n] = result
+
+
+def prefetch_table_rows(count=2):
+    """Render the next `count` rows of the variable table in the
+    background while the current row is being typed.
+    """
+    rendered = var_table['rendered']
+    text = current_template['text']
+    varsdict = current_template['varsdict']
+    allowblank = allowblankline.get()
+    if var_table['source'] != (text, allowblank):
+        # The template was reloaded or the option changed, renders
+        # still running are stale
+        var_table['source'] = (text, allowblank)
+        var_table['generation'] += 1
+        rendered.clear()
+    wanted = range(var_table['index'] + 1, var_table['index'] + 1 + count)
+    for n in list(rendered):
+        if n not in wanted:
+            del rendered[n]
+    for n in wanted:
+        if n < len(var_table['rows']) and n not in rendered:
+            rendered[n] = None
+            values = template_values(varsdict, var_table['rows'][n])
+            threading.Thread(
+                target=prerender_worker,
+                args=(
+                    var_table, var_table['generation'], n, text, values,
+                    allowblank,
+                    ),
+                daemon=True,
+                ).start()
+
+
+def show_table_row(n):
+    """Replace the list with the template rendered with row `n` of the
+    variable table, using the background render when it is ready.
+    """
+    global current_template
+    global lazy_expansion
+    if not var_table or not current_template:
+        return False
+    if not 0 <= n < len(var_table['rows']):
+        searchstatus.set('No more rows')
+        return False
+    text = current_template['text']
+    values = template_values(
+        current_template['varsdict'], var_table['rows'][n]
+        )
+    allowblank = allowblankline.get()
+    recipe = {'render': text, 'values': values, 'allowblank': allowblank}
+    cached = var_table['rendered'].pop(n, None)
+    if var_table['source'] != (text, allowblank):
+        cached = None
+    if cached and cached[0] == var_table['generation']:
+        _, lines, blocks, store, error = cached
+    else:
+        store = error = None
+        try:
+            lines, blocks = render_lines(text, values, allowblank)
+        except (KeyError, ValueError, IndexError, AttributeError) as e:
+            error = e
+    if error:
+        title = 'Render failed'
+        message = f"Row {n+1} could not be rendered: {error!r}"
+        tk.messagebox.showwarning(title=title, message=message)
+        return False
+    list_replace(lines, recipe, store)
+    lazy_expansion = LazyBlocks(blocks, recipe) if blocks else None
+    current_template = {**current_template, 'values': values}
+    var_table['index'] = n
+    set_listbox_selection(0)
+    jumpovercommentlines()
+    searchstatus.set(f"Row {n+1} of {len(var_table['rows'])}")
+    prefetch_table_rows()
+
+
+def next_table_row():
+    """Render the next row of the variable table."""
+    if var_table:
+        show_table_row(var_table['index'] + 1)
+
+
+def previous_table_row():
+    """Render the previous row of the variable table."""
+    if var_table:
+        show_table_row(var_table['index'] - 1)
+
+
+def template_values(varsdict, oldvalues):
+    """Return the variable values for a template, reusing the previous
+    values and using the first default for new variables.
+    """
+    oldvalues = oldvalues or {}
+    return {k: oldvalues.get(k, v[0]) for k, v in varsdict.items()}
+
+
+def line_diff(oldlines, newlines, limit=5000):
+    """Return the opcodes (as `difflib.SequenceMatcher.get_opcodes`) to
+    change `oldlines` into `newlines`, or None if more than `limit`
+    lines between the common start and end need to be matched.
+    When the lines in between are the same number they are compared
+    line by line, otherwise they are matched by number with autojunk,
+    which skips popular lines like repeated `exit`s.
+    """
+    size = min(len(oldlines), len(newlines))
+    start = 0
+    while start < size and oldlines[start] == newlines[start]:
+        start += 1
+    end = 0
+    while end < size - start and oldlines[-1-end] == newlines[-1-end]:
+        end += 1
+    i2, j2 = len(oldlines) - end, len(newlines) - end
+    opcodes = [('equal', 0, start, 0, start)] if start else []
+    if i2 - start == j2 - start:
+        for same, rows in itertools.groupby(
+                range(start, i2), lambda n: oldlines[n] == newlines[n]):
+            rows = list(rows)
+            tag = 'equal' if same else 'replace'
+            opcodes.append((tag, rows[0], rows[-1] + 1, rows[0], rows[-1] + 1))
+    elif (i2 - start) + (j2 - start) > limit:
+        return None
+    else:
+        numbers = {}
+        a = [numbers.setdefault(line, len(numbers))
+             for line in oldlines[start:i2]]
+        b = [numbers.setdefault(line, len(numbers))
+             for line in newlines[start:j2]]
+        matcher = difflib.SequenceMatcher(None, a, b)
+        for tag, a1, a2, b1, b2 in matcher.get_opcodes():
+            opcodes.append(
+                (tag, a1 + start, a2 + start, b1 + start, b2 + start)
+                )
+    if end:
+        opcodes.append(('equal', i2, len(oldlines), j2, len(newlines)))
+    return opcodes
+
+
+def apply_line_diff(newlines, recipe=None):
+    """Change the list into `newlines` by inserting and deleting only
+    the lines which differ. The selection stays on the same line.
+    """
+    global listrecipe
+    curpos = current_position() or 0
+    newpos = None
+    newlines = list(newlines)
+    opcodes = line_diff(listlines[:], newlines)
+    for tag, i1, i2, j1, j2 in opcodes or ():
+        if i1 <= curpos < i2:
+            # Changed lines keep their row as far as there are new lines
+            newpos = j1 + min(curpos - i1, max(j2 - j1 - 1, 0))
+            break
+    if opcodes is None:
+        # Too much to match, keep the selection on the same row
+        list_replace(newlines, recipe)
+        newpos = curpos
+    elif len(opcodes) > 1000:
+        # Too many small changes, replacing the list is faster
+        list_replace(newlines, recipe)
+    else:
+        for tag, i1, i2, j1, j2 in reversed(opcodes):
+            if tag in ('delete', 'replace'):
+                list_delete(i1, i2 - 1)
+            if tag in ('insert', 'replace'):
+                list_insert(i1, newlines[j1:j2])
+        if recipe:
+            listrecipe = recipe
+    if not listlines:
+        list_insert(0, [''])
+    newpos = len(listlines) - 1 if newpos is None else newpos
+    set_listbox_selection(min(newpos, len(listlines) - 1))
+
+
+def reload_template():
+    """Read the imported file again and update the changed lines using
+    the last variable values, without prompting.
+    """
+    global current_template
+    global lazy_expansion
+    importfile = pathlib.Path(current_template['filename'])
+    try:
+        text, varsdict = readtemplate(importfile)
+    except (OSError, ValueError):
+        # The file may be in the middle of being replaced
+        return False
+    allowblank = allowblankline.get()
+    if varsdict:
+        values = template_values(varsdict, current_template['values'])
+    else:
+        values = None
+    recipe = {
+        'render': text,
+        'values': values,
+        'allowblank': allowblank,
+        'expanded': expanded_blocks(),
+        }
+    lines, lazy = render_recipe(recipe)
+    current_template = {
+        'filename': current_template['filename'],
+        'text': text,
+        'varsdict': varsdict,
+        'values': values,
+        }
+    apply_line_diff(lines, recipe)
+    lazy_expansion = lazy
+
+
+def inotify_open(path):
+    """Watch the directory of a file with inotify (Linux only).
+    Return the inotify file descriptor or None if not available.
+    """
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    # IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE, editors often save by
+    # writing a new file and renaming it over the old one
+    mask = 0x8 | 0x80 | 0x100
+    if libc.inotify_add_watch(fd, os.fsencode(path.parent), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def inotify_worker(fd, state):
+    """Thread to read inotify events and check the watched file in the
+    GUI thread when an event names it.
+    """
+    import select
+    import struct
+    name = os.fsencode(state['path'].name)
+    try:
+        while not state['stop'].is_set():
+            ready, _, _ = select.select([fd], [], [], 1)
+            if not ready:
+                continue
+            data = os.read(fd, 65536)
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = struct.unpack_from('iIII', data, offset)
+                eventname = data[offset+16:offset+16+length].rstrip(b'\0')
+                offset += 16 + length
+                if eventname == name and not state['stop'].is_set():
+                    root.after(0, check_watched_file, state)
+    finally:
+        os.close(fd)
+
+
+def file_signature(path):
+    """Return the mtime and size of a file, or None if it is missing."""
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def start_watching():
+    """Watch the imported file if the reload option is enabled."""
+    global watch_state
+    stop_watching()
+    if not watchfile.get() or not current_template:
+        return False
+    path = pathlib.Path(current_template['filename'])
+    watch_state = {
+        'path': path,
+        'signature': file_signature(path),
+        'stop': threading.Event(),
+        'afterid': None,
+        }
+    fd = inotify_open(path)
+    if fd is not None:
+        threading.Thread(
+            target=inotify_worker, args=(fd, watch_state), daemon=True
+            ).start()
+    else:
+        poll_watched_file()
+
+
+def stop_watching():
+    """Stop watching the imported file."""
+    global watch_state
+    if watch_state:
+        watch_state['stop'].set()
+        if watch_state['afterid']:
+            root.after_cancel(watch_state['afterid'])
+    watch_state = None
+
+
+def check_watched_file(state):
+    """Reload the imported file if its mtime or size changed since it
+    was last read. `state` is the watch it was checked for.
+    """
+    if state is not watch_state:
+        # Checked for a file which is no longer watched
+        return False
+    signature = file_signature(state['path'])
+    if signature and signature != state['signature']:
+        state['signature'] = signature
+        reload_template()
+
+
+def poll_watched_file():
+    """Check the imported file once a second without inotify."""
+    check_watched_file(watch_state)
+    watch_state['afterid'] = root.after(1000, poll_watched_file)
+
+
+def parse_fragment(path):
+    """Return a file split into parts: lists of lines and the
+    (`include` or `vars-from`, path) directives between them.
+    The result is cached until the file's mtime or size changes.
+    """
+    signature = file_signature(path)
+    cached = fragment_cache.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    parts = [[]]
+    directive = re.compile(r'^## ?(include|vars-from):(.+)$')
+    for line in path.read_text().splitlines():
+        m = directive.match(line)
+        if m:
+            target = (path.parent / m[2].strip()).resolve()
+            parts.extend([(m[1], target), []])
+        else:
+            parts[-1].append(line)
+    fragment_cache[path] = (signature, parts)
+    return parts
+
+
+def assemble_template(path, stack=()):
+    """Return the lines of a template with its `##include:` files
+    inserted and the `##var:` lines of its `##vars-from:` files added.
+    Raise ValueError if files include each other in a loop.
+    """
+    path = pathlib.Path(path).resolve()
+    if path in stack:
+        chain = ' -> '.join(p.name for p in (*stack, path))
+        raise ValueError(f"Include loop: {chain}")
+    lines = []
+    for part in parse_fragment(path):
+        if isinstance(part, list):
+            lines.extend(part)
+            continue
+        kind, target = part
+        included = assemble_template(target, (*stack, path))
+        if kind == 'include':
+            lines.extend(included)
+        else:
+            lines.extend(x for x in included if re.match(r'^## ?var:', x))
+    return lines
+
+
+@profiled('import')
+def readtemplate(importfile):
+    """Read an import file with its included files.
+    Return the text and its variables, precompiled by `lint` if they
+    are saved and none of the files changed.
+    """
+    compiled = load_compiled(importfile)
+    if compiled:
+        return compiled
+    text = '\n'.join(assemble_template(importfile))
+    return text, parse_template_vars(text)
+
+
+def traced_template(path, files, problems, stack=()):
+    """Return the (file, line number, line) of each line that
+    `assemble_template` returns for a template. Every file read is
+    added to the `files` set and include errors to `problems`.
+    """
+    files.add(path)
+    lines = []
+    lineno = 1
+    for part in parse_fragment(path):
+        if isinstance(part, list):
+            lines.extend((path, n, x) for n, x in enumerate(part, lineno))
+            lineno += len(part)
+            continue
+        kind, target = part
+        if target == path or target in stack:
+            chain = ' -> '.join(p.name for p in (*stack, path, target))
+            problems.append((path, lineno, f"include loop: {chain}"))
+        else:
+            try:
+                included = traced_template(
+                    target, files, problems, (*stack, path)
+                    )
+            except (OSError, UnicodeDecodeError) as e:
+                problems.append((path, lineno, f"cannot {kind}: {e}"))
+                included = []
+            if kind == 'include':
+                lines.extend(included)
+            else:
+                lines.extend(
+                    x for x in included if re.match(r'^## ?var:', x[2])
+                    )
+        lineno += 1
+    return lines
+
+
+def init_lint_worker():
+    """Set up a `lint` worker process."""
+    global fragment_cache
+    fragment_cache = {}
+
+
+def lint_template(path):
+    """Check a template for include errors, unknown placeholders,
+    unused variables and bad format specs. Return the problems as
+    (file, line number, message), the files read, and the compiled
+    template, or None if an included file is missing.
+    """
+    path = pathlib.Path(path).resolve()
+    files = set()
+    problems = []
+    try:
+        lines = traced_template(path, files, problems)
+    except (OSError, UnicodeDecodeError) as e:
+        return [(str(path), 0, f"cannot read: {e}")], [str(path)], None
+    includeerrors = bool(problems)
+    text = '\n'.join(x[2] for x in lines)
+    varsdict = parse_template_vars(text)
+    varlines = {}
+    used = set()
+    formatter = string.Formatter()
+    for file, n, line in lines:
+        m = re.match(r'^## ?var:(?P<name>[^:=]+)', line)
+        if m:
+            varlines.setdefault(m['name'].strip(), (file, n))
+        if re.match(r'^[#;][^ a-zA-Z0-9]', line):
+            # Not rendered
+            continue
+        try:
+            fields = [
+                (field, spec, conversion)
+                for _, field, spec, conversion in formatter.parse(line)
+                if field is not None
+                ]
+            for field, spec, _ in list(fields):
+                fields.extend(
+                    (nested, '', None)
+                    for _, nested, _, _ in formatter.parse(spec)
+                    if nested is not None
+                    )
+        except ValueError as e:
+            problems.append((file, n, f"bad format string: {e}"))
+            continue
+        for field, spec, conversion in fields:
+            name = re.match(r'[^.[]*', field)[0]
+            if not name or name.isdigit():
+                message = f"placeholder {{{field}}} has no variable name"
+            elif name not in varsdict:
+                message = f"unknown placeholder {{{name}}}"
+            elif conversion not in (None, 'r', 's', 'a'):
+                message = f"bad conversion {{{field}!{conversion}}}"
+            else:
+                used.add(name)
+                if '{' in spec:
+                    continue
+                try:
+                    # Variable values are always strings
+                    format('', spec)
+                    continue
+                except ValueError as e:
+                    message = f"bad format spec {{{field}:{spec}}}: {e}"
+            problems.append((file, n, message))
+    for name in varsdict:
+        if name not in used:
+            file, n = varlines[name]
+            problems.append((file, n, f"variable {name} is never used"))
+    problems = [(str(file), n, message) for file, n, message in problems]
+    problems.sort(key=lambda problem: problem[:2])
+    if includeerrors:
+        return problems, sorted(map(str, files)), None
+    compiled = {
+        'text': text,
+        'varsdict': varsdict,
+        'files': {str(file): file_signature(file) for file in files},
+        }
+    return problems, sorted(compiled['files']), compiled
+
+
+def open_compiled_db(compiledfile):
+    """Open the compiled templates file and create its table."""
+    compiledfile.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(compiledfile)
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS compiled ('
+        'path TEXT PRIMARY KEY, files TEXT, text TEXT, varsdict TEXT)'
+        )
+    return connection
+
+
+def load_compiled(importfile):
+    """Return the text and variables of a template compiled by `lint`,
+    or None if it was not compiled or one of its files changed since.
+    """
+    if compiled_file is None or not compiled_file.exists():
+        return None
+    try:
+        connection = sqlite3.connect(compiled_file)
+        try:
+            row = connection.execute(
+                'SELECT files, text, varsdict FROM compiled WHERE path=?',
+                (str(pathlib.Path(importfile).resolve()),),
+                ).fetchone()
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return None
+    if not row:
+        return None
+    files, text, varsdict = row
+    for file, signature in json.loads(files).items():
+        if list(file_signature(pathlib.Path(file)) or ()) != signature:
+            return None
+    return text, json.loads(varsdict)
+
+
+def lint_main(argv):
+    """Run the `lint` command. Return the exit status, 1 if there were
+    any problems. Templates included by other templates are only
+    checked as part of them.
+    """
+    args = parse_lint_arguments().parse_args(argv)
+    if not args.directory.is_dir():
+        print(f"{args.directory} is not a directory", file=sys.stderr)
+        return 2
+    templates = sorted(args.directory.rglob('*.txt'))
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.jobs, initializer=init_lint_worker,
+            ) as executor:
+        results = list(executor.map(lint_template, templates, chunksize=8))
+    readfiles = {
+        str(templatefile.resolve()): set(files)
+        for templatefile, (_, files, _) in zip(templates, results)
+        }
+    # Files included by a template which they do not include in a loop
+    included = {
+        file for path, files in readfiles.items() for file in files
+        if file != path and path not in readfiles.get(file, ())
+        }
+    reported = set()
+    connection = None if args.no_cache else open_compiled_db(args.cache)
+    for templatefile, (problems, _, compiled) in zip(templates, results):
+        if str(templatefile.resolve()) not in included:
+            for problem in problems:
+                if problem not in reported:
+                    reported.add(problem)
+                    file, n, message = problem
+                    print(f"{os.path.relpath(file)}:{n}: {message}")
+        if connection and compiled:
+            connection.execute(
+                'INSERT OR REPLACE INTO compiled '
+                '(path, files, text, varsdict) VALUES (?, ?, ?, ?)',
+                (
+                    str(templatefile.resolve()),
+                    json.dumps(compiled['files']),
+                    compiled['text'],
+                    json.dumps(compiled['varsdict']),
+                    ),
+                )
+    if connection:
+        connection.commit()
+        connection.close()
+    print(
+        f"{len(templates)} templates checked, "
+        f"{len(reported)} problems found"
         )
-    myvarsbtns1[-1].grid(column=1, columnspan=3, row=n+1, rowspan=3)
-    myvarsbtns1[-1].grid(sticky='EWNS')
-    myvars.bind('<Escape>', lambda event: childdismiss(myvars))
-    myvars.bind('<Return>', lambda event: updatechildcombo(
-        myvars, text, varsdict, myvarscmbs2
-        ))
-    for child in mychild.winfo_children():
-        child.grid_configure(padx=2, pady=2)
-    myvars.update()
-    myvars.minsize(myvars.winfo_width(), myvars.winfo_height())
-    myvars.maxsize(myvars.winfo_width(), myvars.winfo_height())
-    myvars.grab_set()
-    myvars.focus()
-    myvars.wait_window()
+    return 1 if reported else 0
+
+
+def build_search_index(lines):
+    """Return the lines in lowercase for case insensitive searching."""
+    return [line.lower() for line in lines]
+
+
+def find_match_lines(lines, query, regex, candidates=None):
+    """Return the sorted line numbers where the query is found.
+    Only the `candidates` line numbers are searched if given.
+    """
+    if regex:
+        search = re.compile(query).search
+        if candidates is None:
+            return [n for n, line in enumerate(lines) if search(line)]
+        return [n for n in candidates if search(lines[n])]
+    if candidates is None:
+        return [n for n, line in enumerate(lines) if query in line]
+    return [n for n in candidates if query in lines[n]]
+
+
+def update_search(step=0):
+    """Find the query in the list and select a match.
+    `step` 0 selects the first match from the selected line onwards
+    (incremental search), 1 the next match, and -1 the previous match.
+    Lowercase queries ignore case (smart case).
+    """
+    global search_index
+    global search_matches
+    global search_key
+    query = searchtext.get()
+    regex = searchregex.get()
+    if not query:
+        search_matches = []
+        search_key = None
+        searchstatus.set('')
+        return False
+    ignorecase = query == query.lower()
+    key = (query, regex, ignorecase)
+    if lazy_expansion:
+        # Matches may be in generated blocks not added yet
+        expand_all_lazy_lines()
+    if key != search_key:
+        if ignorecase and search_index is None:
+            search_index = build_search_index(listlines)
+        lines = search_index if ignorecase else listlines
+        candidates = None
+        if (search_key and not regex and search_key[1:] == key[1:]
+                and query.startswith(search_key[0])):
+            # A longer query only matches lines the shorter one matched
+            candidates = search_matches
+        try:
+            search_matches = find_match_lines(lines, query, regex, candidates)
+        except re.error as e:
+            search_key = None
+            searchstatus.set(f"Invalid regex: {e}")
+            return False
+        search_key = key
+    if not search_matches:
+        searchstatus.set('No matches')
+        return False
+    curpos = current_position() or 0
+    if step > 0:
+        n = bisect.bisect_right(search_matches, curpos)
+    elif step < 0:
+        n = bisect.bisect_left(search_matches, curpos) - 1
+    else:
+        n = bisect.bisect_left(search_matches, curpos)
+    n = n % len(search_matches)
+    set_listbox_selection(search_matches[n])
+    searchentry.focus_set()
+    searchstatus.set(f"{n+1} of {len(search_matches)} matches")
 
 
-def importfromfile(filename=''):
-    """Import a file and replace the contents of the list."""
-    if not filename:
-        initialdir = pathlib.Path()
-        filename = tkinter.filedialog.askopenfilename(
-            #initialdir=initialdir,  # omit so last location is used
-            defaultextension='.txt',
-            filetypes=(('Text file', '.txt'), ('All files', '*.*'))
+def jump_to_line():
+    """Select the line number typed in the jump to line box."""
+    try:
+        lineno = int(jumptext.get())
+    except ValueError:
+        searchstatus.set('Enter a line number')
+        return False
+    if lazy_expansion and lineno > len(listlines):
+        expand_all_lazy_lines(lineno)
+    pos = max(1, min(lineno, len(listlines))) - 1
+    set_listbox_selection(pos)
+    searchstatus.set(f"Line {pos+1} of {len(listlines)}")
+
+
+def update_search_index(first, last, lines):
+    """Replace the lines `first` to `last` (exclusive) of the search
+    index so it stays current without being rebuilt.
+    """
+    global search_key
+    search_key = None
+    if search_index is not None:
+        search_index[first:last] = build_search_index(lines)
+
+
+class LineStore(collections.abc.MutableSequence):
+    """The lines of the list kept in blocks of up to `block_size` lines
+    instead of one str object per line. Each block is a UTF-8 buffer of
+    the lines ending in newlines, an array of offsets where each line
+    starts, and one byte classifying each line. Blocks are never
+    changed, a change replaces the blocks it touches, so copies share
+    their blocks. A change swaps in the new blocks under `lock`, which
+    reads of single lines and slices also take, so other threads never
+    see the blocks and their starts out of step. The comment flags of
+    all lines are joined into one bytes object when first needed, so
+    moving through the list does not decode any lines.
+    """
+
+    TEXT, COMMENT, BLANK = 0, 1, 2
+    block_size = 4096
+    # The kind of a line from its first byte
+    kind_table = bytearray(256)
+    kind_table[ord('\n')] = BLANK
+    kind_table[ord('#')] = COMMENT
+    kind_table = bytes(kind_table)
+    # 1 for a comment line, 0 otherwise, from the kind of a line
+    comment_table = bytearray(256)
+    comment_table[COMMENT] = 1
+    comment_table = bytes(comment_table)
+
+    def __init__(self, lines=()):
+        self.lock = threading.Lock()
+        self.flags = None
+        self.blocks = []
+        self.starts = []
+        self.size = 0
+        self.splice(0, 0, lines)
+
+    @classmethod
+    def make_blocks(cls, lines):
+        """Return the blocks for a list of lines."""
+        blocks = []
+        for n in range(0, len(lines), cls.block_size):
+            chunk = lines[n:n+cls.block_size]
+            text = '\n'.join(chunk) + '\n'
+            data = text.encode()
+            if len(data) == len(text):
+                lengths = map(len, chunk)
+            else:
+                lengths = (len(line.encode()) for line in chunk)
+            offsets = array.array('I', itertools.accumulate(
+                map((1).__add__, lengths), initial=0
+                ))
+            kinds = bytes(map(data.__getitem__, offsets[:-1]))
+            blocks.append((data, offsets, kinds.translate(cls.kind_table)))
+        return blocks
+
+    @staticmethod
+    def block_lines(block, first=0, last=None):
+        """Return the lines of a block from `first` to `last`."""
+        data, offsets, kinds = block
+        last = len(kinds) if last is None else last
+        if first == 0 and last == len(kinds):
+            lines = data.decode().split('\n')
+            # Unless a line contains a newline itself
+            if len(lines) == len(kinds) + 1:
+                return lines[:-1]
+        return [
+            data[offsets[n]:offsets[n+1]-1].decode()
+            for n in range(first, last)
+            ]
+
+    def locate(self, index):
+        """Return the block of a line and the line's position in it."""
+        b = bisect.bisect_right(self.starts, index) - 1
+        return b, index - self.starts[b]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.size)
+            if step != 1:
+                return [self[n] for n in range(start, stop, step)]
+            lines = []
+            with self.lock:
+                while start < stop:
+                    b, n = self.locate(start)
+                    block = self.blocks[b]
+                    last = min(len(block[2]), n + stop - start)
+                    lines += self.block_lines(block, n, last)
+                    start += last - n
+            return lines
+        with self.lock:
+            b, n = self.locate(range(self.size)[index])
+            data, offsets, _ = self.blocks[b]
+        return data[offsets[n]:offsets[n+1]-1].decode()
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self.splice(*self.span(index), value)
+        else:
+            index = range(self.size)[index]
+            self.splice(index, index + 1, [value])
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            self.splice(*self.span(index), ())
+        else:
+            index = range(self.size)[index]
+            self.splice(index, index + 1, ())
+
+    def __iter__(self):
+        # A change replaces the list of blocks instead of changing it
+        for block in self.blocks:
+            yield from self.block_lines(block)
+
+    def __contains__(self, value):
+        if value == '':
+            return any(self.BLANK in kinds for _, _, kinds in self.blocks)
+        return super().__contains__(value)
+
+    def span(self, index):
+        """Return the start and stop of a slice with a step of 1."""
+        start, stop, step = index.indices(self.size)
+        if step != 1:
+            raise ValueError('LineStore slices must have a step of 1')
+        return start, max(start, stop)
+
+    def insert(self, index, value):
+        self[index:index] = [value]
+
+    def splice(self, start, stop, lines):
+        """Replace the lines from `start` to `stop` with `lines`."""
+        lines = list(lines)
+        if start == stop and not lines:
+            return
+        blocks = self.blocks
+        if blocks:
+            first = self.locate(min(start, self.size - 1))[0]
+            last = self.locate(stop - 1)[0] if stop > start else first
+            head = start - self.starts[first]
+            new = self.block_lines(blocks[first], 0, head)
+            new += lines
+            new += self.block_lines(blocks[last], stop - self.starts[last])
+            # Join a small block to the next so deletes do not leave
+            # many tiny blocks behind
+            if len(new) < self.block_size // 2 and last + 1 < len(blocks):
+                last += 1
+                new += self.block_lines(blocks[last])
+        else:
+            first, last, new = 0, -1, lines
+        blocks = blocks[:first] + self.make_blocks(new) + blocks[last+1:]
+        sizes = [len(kinds) for _, _, kinds in blocks]
+        starts = list(itertools.accumulate(sizes[:-1], initial=0))
+        with self.lock:
+            self.blocks = blocks
+            self.starts = starts
+            self.size = sum(sizes)
+            self.flags = None
+
+    def comment_flags(self):
+        """Return a bytes object with 1 for each line starting with `#`
+        and 0 for the others.
+        """
+        flags = self.flags
+        if flags is None:
+            with self.lock:
+                kinds = b''.join(kinds for _, _, kinds in self.blocks)
+                flags = self.flags = kinds.translate(self.comment_table)
+        return flags
+
+    def is_comment(self, index):
+        """Return True if the line at `index` starts with `#`."""
+        return self.comment_flags()[index] == 1
+
+    def copy(self):
+        """Return a copy sharing the blocks with this store."""
+        other = LineStore()
+        with self.lock:
+            other.blocks = list(self.blocks)
+            other.starts = list(self.starts)
+            other.size = self.size
+        return other
+
+    def nbytes(self):
+        """Return the memory used by the buffers, offsets and kinds."""
+        return sum(
+            len(data) + len(offsets) * offsets.itemsize + len(kinds)
+            for data, offsets, kinds in self.blocks
             )
-    if not filename:
+
+
+def list_insert(pos, lines, record=True):
+    """Insert lines into the list model and the listbox at `pos`.
+    If `record` is False the insert is not added to the undo history.
+    """
+    global listrecipe
+    lines = tuple(lines)
+    listlines[pos:pos] = lines
+    if lines:
+        listbox.insert(pos, *lines)
+        update_search_index(pos, pos, lines)
+        if record:
+            listrecipe = None
+            record_undo(('insert', pos, lines))
+        journal_session('op', ('insert', pos, lines))
+
+
+def list_delete(first, last=None):
+    """Delete the lines from `first` to `last` (inclusive) of the list."""
+    global listrecipe
+    last = first if last is None else last
+    record_undo(('delete', first, tuple(listlines[first:last+1])))
+    del listlines[first:last+1]
+    listbox.delete(first, last)
+    listrecipe = None
+    update_search_index(first, last + 1, ())
+    journal_session('op', ('delete', first, last - first + 1))
+
+
+def list_remove(rows):
+    """Remove the lines at the sorted `rows` with one model change and
+    one redraw. The undo history keeps only the removed lines.
+    """
+    rows = tuple(rows)
+    if not rows:
         return False
-    importfile = pathlib.Path(filename)
-    if importfile.exists():
-        text = importfile.read_text()
-    else:
-        title = 'File does not exist'
-        message = f"{importfile} does not exist"
-        tk.messagebox.showwarning(title=title, message=message)
+    lines = listlines[:]
+    removed = tuple(lines[row] for row in rows)
+    list_replace(delete_rows(lines, rows), change=('remove', rows, removed))
+
+
+def list_replace(lines, recipe=None, store=None, change=None):
+    """Replace the whole list with one model change and one redraw.
+    `recipe` describes how to make `lines` again so the undo history
+    does not need to keep a copy of them (see `materialize`).
+    `store` is a LineStore of `lines` if one was made beforehand.
+    `change` is the undo history entry to log instead of the whole
+    list before and after.
+    """
+    global listlines
+    global listrecipe
+    global search_index
+    global search_key
+    global lazy_expansion
+    lines = tuple(lines)
+    # The old store is not changed after this, so it is kept as it is
+    before = listrecipe if listrecipe else listlines
+    listlines = store if store is not None else LineStore(lines)
+    if change:
+        record_undo(change)
+    elif not undo_replaying:
+        after = recipe if recipe else listlines.copy()
+        record_undo(('replace', before, after))
+    listbox_text.set(lines)
+    search_index = None
+    search_key = None
+    listrecipe = recipe if recipe and 'render' in recipe else None
+    lazy_expansion = None
+    journal_session('snapshot', listlines.copy())
+
+
+def materialize(state):
+    """Return the lines described by an undo history state, and the
+    LazyBlocks still to be generated for a render (or None).
+    A state is a tuple of lines, a template render recipe, or a
+    function applied to the current lines.
+    """
+    if isinstance(state, (tuple, LineStore)):
+        return state, None
+    if 'apply' in state:
+        return state['apply'](listlines), None
+    return render_recipe(state)
+
+
+def record_undo(op):
+    """Add a list change to the undo history.
+    Changes made while handling one event are undone together.
+    """
+    global undo_group
+    if undo_replaying:
         return False
-    # Search for variables in the import file
-    # It is valid to have only a variable name and no values
-    varsregex = re.compile(r'^## ?var:(?P<name>[^:=]+)[:=]?(?P<values>.*)?')
-    varsmatch = [varsregex.match(t) for t in text.splitlines()]
-    varsdict = {
-        m['name'].strip(): m['values'].strip() if m['values'] else ''
-        for m in varsmatch
-        if m and m['name'] #and m['values']
-        }
-    varsdict = {
-        k: [v.strip() or '' for v in v.split(',') ] #if v]
-        for k,v in varsdict.items()
-        }
-    if varsdict:
-        importwithvars(text, varsdict)
-    elif not varsdict:
-        importwithoutvars(text)
-    else:
+    if undo_group is None:
+        undo_group = []
+        undo_stack.append(undo_group)
+        del undo_stack[:-undo_limit]
+        root.after_idle(close_undo_group)
+    undo_group.append(op)
+    redo_stack.clear()
+
+
+def close_undo_group():
+    """Start a new undo step for the next list change."""
+    global undo_group
+    undo_group = None
+
+
+def replay_ops(ops, reverse):
+    """Apply (or revert if `reverse`) logged list changes.
+    Return the position of the last change.
+    """
+    global undo_replaying
+    global lazy_expansion
+    undo_replaying = True
+    pos = 0
+    try:
+        for op in (ops[::-1] if reverse else ops):
+            kind, first, second = op
+            if kind == 'replace':
+                state = first if reverse else second
+                recipe = state if isinstance(state, dict) else None
+                lines, lazy = materialize(state)
+                list_replace(lines, recipe)
+                lazy_expansion = lazy
+                pos = current_position() or 0
+                continue
+            if kind == 'remove':
+                lines = listlines[:]
+                if reverse:
+                    list_replace(restore_rows(lines, first, second))
+                else:
+                    list_replace(delete_rows(lines, first))
+                pos = first[0]
+                continue
+            pos = first
+            if (kind == 'insert') != reverse:
+                list_insert(first, second)
+            else:
+                list_delete(first, first + len(second) - 1)
+    finally:
+        undo_replaying = False
+    return pos
+
+
+def undo():
+    """Revert the last change to the list."""
+    close_undo_group()
+    if not undo_stack:
+        return False
+    ops = undo_stack.pop()
+    pos = replay_ops(ops, reverse=True)
+    redo_stack.append(ops)
+    set_listbox_selection(min(pos, len(listlines) - 1))
+
+
+def redo():
+    """Apply the last undone change to the list again."""
+    close_undo_group()
+    if not redo_stack:
         return False
+    ops = redo_stack.pop()
+    pos = replay_ops(ops, reverse=False)
+    undo_stack.append(ops)
+    set_listbox_selection(min(pos, len(listlines) - 1))
 
 
-def set_listbox_selection(position):
-    """Set the listbox selection and make it visible (scroll)"""
+def current_selection():
+    """Return the sorted positions of the selected lines."""
+    if pending_selection is not None:
+        return (pending_selection,)
+    return listbox.curselection()
+
+
+def current_position():
+    """Return the position of the first selected line or None."""
+    if pending_selection is not None:
+        return pending_selection
+    selected = listbox.curselection()
+    return selected[0] if selected else None
+
+
+def select_rows(rows):
+    """Select the given rows and make the first one visible."""
+    global pending_selection
+    pending_selection = None
+    rows = list(rows)
+    listbox.selection_clear(0, 'end')
+    if not rows:
+        return False
+    first = last = rows[0]
+    for row in rows[1:] + [None]:
+        if row == last + 1:
+            last = row
+            continue
+        listbox.selection_set(first, last)
+        first = last = row
+    listbox.see(rows[0])
+    listbox.activate(rows[0])
+
+
+def set_listbox_selection(position, frame=1/60):
+    """Set the selection and make it visible (scroll). The new position
+    is used right away but the listbox is redrawn at most once per
+    `frame` seconds, so moving quickly through the list redraws once.
+    """
+    global pending_selection
+    global pending_focus
+    global refresh_id
+    pending_selection = position
+    if refresh_id is None:
+        pending_focus = root.tk.call('focus')
+        delay = frame - (time.perf_counter() - last_refresh)
+        if delay > 0:
+            refresh_id = root.after(int(delay * 1000) + 1, refresh_listbox)
+        else:
+            refresh_id = root.after_idle(refresh_listbox)
+
+
+def refresh_listbox():
+    """Show the pending selection in the listbox and give it the focus,
+    unless another widget took the focus since the selection was set.
+    """
+    global pending_selection
+    global refresh_id
+    global last_refresh
+    if refresh_id is not None:
+        root.after_cancel(refresh_id)
+    refresh_id = None
+    position, pending_selection = pending_selection, None
+    if position is None:
+        return False
+    position = max(0, min(position, listbox.size() - 1))
     listbox.selection_clear(0, 'end')
     listbox.selection_set(position)
     listbox.see(position)
-    listbox.focus()
+    if str(root.tk.call('focus')) == str(pending_focus):
+        listbox.focus()
     listbox.activate(position)
+    last_refresh = time.perf_counter()
 
 
 def cycleforward():
     """Move the selection to the next item."""
-    size = listbox.size()
-    if not size:
-        return False
-    if not listbox.curselection():
-        warning_no_selection()
-        return False
-    curpos = listbox.curselection()[0]
-    end = size - 1
-    if curpos < end:
-        set_listbox_selection(curpos+1)
-    if curpos == end:
-        set_listbox_selection(0)
-    curline = listbox.get(listbox.curselection())
-    if skipcommentlines.get() and re.match(r'^#', curline):
-        cycleforward()
+    cyclelist(1)
+
 
 def cyclebackward():
     """Move the selection to the previous item."""
-    size = listbox.size()
+    cyclelist(-1)
+
+
+def cyclelist(step):
+    """Move the selection `step` items, skipping comments if enabled."""
+    size = len(listlines)
     if not size:
         return False
-    if not listbox.curselection():
+    curpos = current_position()
+    if curpos is None:
         warning_no_selection()
         return False
-    curpos = listbox.curselection()[0]
-    if curpos > 0:
-        set_listbox_selection(curpos-1)
-    if curpos == 0:
-        set_listbox_selection('end')
-    curline = listbox.get(listbox.curselection())
-    if skipcommentlines.get() and re.match(r'^#', curline):
-        cyclebackward()
+    if step > 0 and lazy_expansion:
+        expand_lazy_lines(curpos)
+        size = len(listlines)
+    newpos = next_position(
+        listlines.comment_flags().__getitem__, size, curpos, step,
+        skipcommentlines.get(),
+        )
+    if step < 0 and newpos > curpos and lazy_expansion:
+        # Wrapping around to the end, which is the last generated block
+        expand_all_lazy_lines()
+        newpos = next_position(
+            listlines.comment_flags().__getitem__, len(listlines), curpos,
+            step, skipcommentlines.get(),
+            )
+    set_listbox_selection(newpos)
 
 
+@profiled('clipboard')
 def checkcb():
-    """Add items from the system clipboard to the list."""
+    """Add text copied to the system clipboard to the clipboard history,
+    and to the list if it matches the clipboard filter. The system
+    clipboard is left as it is.
+    """
     global lastcbvalue
     global hookcbid
-    if pyperclip.paste().strip() != lastcbvalue:
-        lastcbvalue = pyperclip.paste().strip()
-        additem(lastcbvalue)
-        lastcbvalue = ''
-        pyperclip.copy('')
-        if listbox.curselection():
-            listbox.selection_clear(listbox.curselection()[0])
-        listbox.select_set('end')
-        listbox.see('end')
+    value = pyperclip.paste()
+    if value != lastcbvalue:
+        lastcbvalue = value
+        text = value.strip()
+        if text:
+            kept = clipboard_history.add(text)
+            if clipboard_filter.search(text):
+                additem(text)
+                select_rows([len(listlines) - 1])
+            if not kept:
+                searchstatus.set('Too large for history')
+            elif clipboard_view:
+                clipboard_view()
     hookcbid = root.after(10, checkcb)
 
 
+class ClipboardHistory:
+    """The most recent texts copied while the clipboard is hooked.
+    At most `maxlen` texts of `maxbytes` UTF-8 bytes in total are kept,
+    dropping the oldest first. A text copied again is moved to the
+    newest end instead of being stored twice.
+    """
+
+    def __init__(self, maxlen=100, maxbytes=2**20):
+        self.maxlen = maxlen
+        self.maxbytes = maxbytes
+        self.entries = collections.OrderedDict()  # text: size in bytes
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        """Iterate over the texts, newest first."""
+        return reversed(self.entries)
+
+    def add(self, text):
+        """Add a text. Return False if it is larger than `maxbytes`."""
+        if text in self.entries:
+            self.entries.move_to_end(text)
+            return True
+        size = len(text.encode('utf-8'))
+        if size > self.maxbytes:
+            return False
+        self.entries[text] = size
+        self.nbytes += size
+        while len(self.entries) > self.maxlen or self.nbytes > self.maxbytes:
+            _, oldsize = self.entries.popitem(last=False)
+            self.nbytes -= oldsize
+        return True
+
+    def remove(self, text):
+        """Remove a text from the history."""
+        self.nbytes -= self.entries.pop(text, 0)
+
+    def clear(self):
+        """Remove every text."""
+        self.entries.clear()
+        self.nbytes = 0
+
+
+def clipboard_window():
+    """Child window to add texts from the clipboard history to the list."""
+    global clipboard_view
+    if clipboard_view:
+        clipboard_view()
+        return False
+    mycb = tk.Toplevel(root)
+    mycb.title('Clipboard history')
+    mychild = ttk.Frame(mycb, padding=(2,2,2,2))
+    mychild.grid(column=0, row=0, sticky='NWES')
+    mycb.columnconfigure(0, weight=1)
+    mycb.rowconfigure(0, weight=1)
+    mychild.columnconfigure(1, weight=1)
+    mychild.rowconfigure(1, weight=1)
+    lst1 = tk.Listbox(
+        mychild, height=15, width=60, selectmode=tk.EXTENDED,
+        exportselection=False,
+        )
+    lst1.grid(column=1, row=1, columnspan=4, sticky='NWES')
+    sts1 = tk.StringVar()
+    lbl1 = ttk.Label(mychild, textvariable=sts1)
+    lbl1.grid(column=1, row=2, sticky='W')
+    texts = []
+    buttons = [
+        ('Add to list', lambda: add_clipboard_texts(lst1, texts)),
+        ('Remove', lambda: remove_clipboard_texts(lst1, texts)),
+        ('Clear', lambda: remove_clipboard_texts(lst1, texts, True)),
+        ]
+    for column, (label, command) in enumerate(buttons, 2):
+        ttk.Button(mychild, text=label, command=command).grid(
+            column=column, row=2, sticky='WE'
+            )
+    for child in mychild.winfo_children():
+        child.grid_configure(padx=2, pady=2)
+    clipboard_view = lambda: show_clipboard_history(lst1, sts1, texts)
+    mycb.bind('<Destroy>', lambda event: close_clipboard_window(event, mycb))
+    mycb.bind('<Escape>', lambda event: mycb.destroy())
+    lst1.bind('<Double-1>', lambda event: add_clipboard_texts(lst1, texts))
+    lst1.bind('<Return>', lambda event: add_clipboard_texts(lst1, texts))
+    clipboard_view()
+    lst1.focus_set()
+
+
+def show_clipboard_history(results, status, texts, width=80):
+    """Show the first line of each text in the history, newest first."""
+    texts[:] = clipboard_history
+    results.delete(0, 'end')
+    for text in texts:
+        lines = text.splitlines()
+        label = lines[0][:width]
+        if len(lines) > 1:
+            label += f"  ({len(lines)} lines)"
+        results.insert('end', label)
+    status.set(
+        f"{len(texts)} of {clipboard_history.maxlen} texts, "
+        f"{clipboard_history.nbytes / 1024:.0f} of "
+        f"{clipboard_history.maxbytes / 1024:.0f} KiB"
+        )
+
+
+def add_clipboard_texts(results, texts):
+    """Add the selected texts of the clipboard history to the list."""
+    selected = results.curselection()
+    if not selected:
+        return False
+    for row in reversed(selected):
+        additem(texts[row])
+    select_rows([len(listlines) - 1])
+
+
+def remove_clipboard_texts(results, texts, clear=False):
+    """Remove the selected texts, or all, from the clipboard history."""
+    if clear:
+        clipboard_history.clear()
+    for row in results.curselection():
+        clipboard_history.remove(texts[row])
+    clipboard_view()
+
+
+def close_clipboard_window(event, child):
+    """Forget the clipboard history window when it is closed."""
+    global clipboard_view
+    if event.widget is child:
+        clipboard_view = None
+
+
+def make_listbox(variable):
+    """Create the listbox showing a list, with the list's key bindings.
+    The listbox of each named list is kept while it is not shown, so
+    switching lists does not load the lines into the widget again.
+    """
+    selectmode = (tk.BROWSE, tk.EXTENDED, tk.SINGLE, tk.MULTIPLE)[1]
+    activestyle = (tk.UNDERLINE, tk.DOTBOX, tk.NONE)[2]
+    ui_obj = tk.Listbox(mygui, selectmode=selectmode)
+    ui_obj.config(listvariable=variable, height=15)
+    ui_obj.config(exportselection=False, activestyle=activestyle)
+    ui_obj.grid(column=1, columnspan=6, row=3, rowspan=15, sticky='NSWE')
+    ui_obj.grid_configure(padx=(2,0), pady=2)
+    ui_obj.bind('<Button-3>', do_rightclickmenu)
+    ui_obj.bind('<Double-1>', lambda event: copy_item())
+    ui_obj.bind('<Triple-1>', lambda event: edit_item_window())
+    # Return 'break' so the class bindings do not move the selection again
+    ui_obj.bind('<Up>', lambda event: cyclebackward() or 'break')
+    ui_obj.bind('<Down>', lambda event: cycleforward() or 'break')
+    ui_obj.bind('<Alt-Up>', lambda event: moveitemup() or 'break')
+    ui_obj.bind('<Alt-Down>', lambda event: moveitemdown() or 'break')
+    ui_obj.bind('<Control-a>', lambda event: selectallitems() or 'break')
+    ui_obj.bind('<Control-d>', lambda event: duplicateitems())
+    ui_obj.bind('<Control-z>', lambda event: undo())
+    ui_obj.bind('<Control-y>', lambda event: redo())
+    ui_obj.bind('<Control-Z>', lambda event: redo())
+    ui_obj.bind('<Return>', lambda event: copy_gonext())
+    ui_obj.bind('<Delete>', lambda event: removeitem())
+    ui_obj.bind('<Control-Return>', lambda event: toggle_keyboard_threads())
+    ui_obj.bind('<Control-e>', lambda event: edit_item_window())
+    ui_obj.bind('<Control-i>', lambda event: insert_item_after_window())
+    ui_obj.bind('<Control-o>', lambda event: importfromfile())
+    ui_obj.bind('<Control-r>', lambda event: rerender_template())
+    ui_obj.bind('<Control-Next>', lambda event: next_table_row())
+    ui_obj.bind('<Control-Prior>', lambda event: previous_table_row())
+    ui_obj.bind('<Control-l>', lambda event: library_window())
+    ui_obj.bind('<Control-f>', lambda event: searchentry.focus_set())
+    ui_obj.bind('<Control-g>', lambda event: jumpentry.focus_set())
+    ui_obj.bind('<Control-s>', lambda event: savelisttofile())
+    ui_obj.bind('<Control-n>', lambda event: new_list())
+    ui_obj.bind('<Control-Tab>', lambda event: next_list() or 'break')
+    return ui_obj
+
+
+def list_options():
+    """Return the options kept separately for each named list."""
+    return (
+        ('skipcommentlines', skipcommentlines),
+        ('allowblankline', allowblankline),
+        ('reversenextbool', reversenextbool),
+        )
+
+
+def save_list_state():
+    """Store the active list's model, history and options in `lists`."""
+    close_undo_group()
+    lists[active_list].update({
+        'listbox': listbox,
+        'variable': listbox_text,
+        'lines': listlines,
+        'recipe': listrecipe,
+        'template': current_template,
+        'lazy': lazy_expansion,
+        'table': var_table,
+        'undo': undo_stack,
+        'redo': redo_stack,
+        'options': {name: var.get() for name, var in list_options()},
+        })
+
+
+def load_list_state(n):
+    """Make list `n` of `lists` the active list."""
+    global active_list
+    global listbox
+    global listbox_text
+    global listlines
+    global listrecipe
+    global current_template
+    global lazy_expansion
+    global var_table
+    global undo_stack
+    global redo_stack
+    global search_index
+    global search_key
+    state = lists[n]
+    active_list = n
+    listbox = state['listbox']
+    listbox_text = state['variable']
+    listlines = state['lines']
+    listrecipe = state['recipe']
+    current_template = state['template']
+    lazy_expansion = state['lazy']
+    var_table = state['table']
+    undo_stack = state['undo']
+    redo_stack = state['redo']
+    search_index = None
+    search_key = None
+    for name, var in list_options():
+        var.set(state['options'][name])
+
+
+def list_name(n):
+    """Return the name of list `n`, the imported file or its number."""
+    if n == active_list:
+        template = current_template
+    else:
+        template = lists[n]['template']
+    if template:
+        return pathlib.Path(template['filename']).stem
+    return f"List {n+1}"
+
+
+def switch_list(n):
+    """Show list `n` and type from it. The lines are not copied, the
+    other list's listbox is hidden and this list's listbox is shown.
+    """
+    if n == active_list:
+        return False
+    refresh_listbox()
+    stop_watching()
+    save_list_state()
+    listbox.grid_remove()
+    load_list_state(n)
+    listbox.grid()
+    scrollbar.config(command=listbox.yview)
+    listbox.focus()
+    journal_session('snapshot', listlines.copy())
+    start_watching()
+    update_lists_menu()
+
+
+def next_list():
+    """Switch to the next named list, after the last go to the first."""
+    switch_list((active_list + 1) % len(lists))
+
+
+def new_list():
+    """Add an empty named list and switch to it."""
+    variable = tk.StringVar(value=[''])
+    ui_obj = make_listbox(variable)
+    ui_obj['yscrollcommand'] = scrollbar.set
+    ui_obj.grid_remove()
+    ui_obj.selection_set(0)
+    lists.append({
+        'listbox': ui_obj,
+        'variable': variable,
+        'lines': LineStore(['']),
+        'recipe': None,
+        'template': None,
+        'lazy': None,
+        'table': None,
+        'undo': [],
+        'redo': [],
+        'options': {name: var.get() for name, var in list_options()},
+        })
+    switch_list(len(lists) - 1)
+
+
+def close_list():
+    """Remove the active named list and switch to the one before it."""
+    global active_list
+    if len(lists) == 1:
+        title = 'Cannot close list'
+        message = 'The last list cannot be closed'
+        tk.messagebox.showwarning(title=title, message=message)
+        return False
+    closing = active_list
+    closed = listbox
+    switch_list(closing - 1 if closing else 1)
+    lists.pop(closing)
+    closed.destroy()
+    if closing < active_list:
+        active_list -= 1
+    update_lists_menu()
+
+
+def update_lists_menu():
+    """Show the named lists as choices in the `Lists` menu."""
+    mainmenu_lists.delete(lists_menu_first, 'end')
+    activelist.set(active_list)
+    for n in range(len(lists)):
+        mainmenu_lists.add_radiobutton(
+            label=list_name(n),
+            variable=activelist,
+            value=n,
+            command=lambda n=n: switch_list(n),
+            )
+
+
 def savelisttofile():
-    """Save the current list to a file."""
+    """Save the current list to a file in the background.
+    Files ending in `.gz` are compressed with gzip.
+    """
     initialdir = pathlib.Path()
-    filename = tkinter.filedialog.asksaveasfile(
+    filename = tkinter.filedialog.asksaveasfilename(
         #initialdir=initialdir,  # omit so last location is used
         defaultextension='.txt',
-        filetypes=(('Text file', '.txt'), ('All files', '*.*'))
+        filetypes=(
+            ('Text file', '.txt'),
+            ('Gzip text file', '.gz'),
+            ('All files', '*.*'),
+            )
         )
-    if filename:
-        filename.write('\n'.join(listbox.get(0, 'end')))
-        filename.close()
+    if not filename:
+        return False
+    path = pathlib.Path(filename)
+    if lazy_expansion:
+        # Save the generated blocks not added to the list yet too
+        expand_all_lazy_lines()
+    # The copy shares the list's blocks, later edits are not saved
+    lines = listlines.copy()
+    progress = queue.Queue()
+    threading.Thread(
+        target=save_worker, args=(path, lines, progress), daemon=True
+        ).start()
+    poll_save(path, len(lines), progress)
+
+
+def write_lines_atomic(path, lines, progress=None, chunksize=10000):
+    """Write lines to a temporary file next to `path` in chunks, flush it
+    to disk and rename it over `path`, so a crash never leaves a partly
+    written file. `progress` is called with the number of lines written.
+    """
+    fd, tmpname = tempfile.mkstemp(prefix=f".{path.name}.", dir=path.parent)
+    tmpfile = pathlib.Path(tmpname)
+    try:
+        with open(fd, 'wb') as raw:
+            if path.suffix == '.gz':
+                binary = gzip.GzipFile(path.stem, 'wb', fileobj=raw)
+            else:
+                binary = raw
+            # Same encoding and line endings as a file opened with open()
+            text = io.TextIOWrapper(binary)
+            for start in range(0, len(lines), chunksize):
+                if start:
+                    text.write('\n')
+                text.write('\n'.join(lines[start:start+chunksize]))
+                if progress:
+                    progress(min(start + chunksize, len(lines)))
+            text.flush()
+            text.detach()
+            if binary is not raw:
+                binary.close()
+            raw.flush()
+            os.fsync(raw.fileno())
+        if path.exists():
+            shutil.copymode(path, tmpfile)
+        else:
+            tmpfile.chmod(0o644)
+        os.replace(tmpfile, path)
+    except BaseException:
+        tmpfile.unlink(missing_ok=True)
+        raise
+
+
+def save_worker(path, lines, progress):
+    """Thread to save the lines and report progress, then None when
+    finished or the exception if saving failed.
+    """
+    try:
+        write_lines_atomic(path, lines, progress.put)
+    except Exception as e:
+        progress.put(e)
     else:
+        progress.put(None)
+
+
+def poll_save(path, total, progress):
+    """Show the progress of a save in the status and warn if it failed."""
+    item = 0
+    while not progress.empty():
+        item = progress.get()
+        if not isinstance(item, int):
+            break
+    if isinstance(item, int):
+        if item:
+            searchstatus.set(f"Saving {item * 100 // total}%")
+        root.after(100, lambda: poll_save(path, total, progress))
+        return
+    if item is None:
+        searchstatus.set(f"Saved {total} lines")
+        return True
+    searchstatus.set('Save failed')
+    title = 'Save failed'
+    message = f"Could not save {path}\n{item}"
+    tk.messagebox.showwarning(title=title, message=message)
+    return False
+
+
+def open_session_db(sessionfile):
+    """Open the session database in WAL mode and create its tables.
+    The files are only readable by the user since the list and the
+    template values may hold passwords.
+    """
+    os.close(os.open(sessionfile, os.O_CREAT | os.O_WRONLY, 0o600))
+    for path in session_files(sessionfile):
+        if path.exists():
+            path.chmod(0o600)
+    connection = sqlite3.connect(sessionfile)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS snapshot (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            text TEXT NOT NULL
+            );
+        CREATE TABLE IF NOT EXISTS journal (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT NOT NULL
+            );
+        CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+            );
+        ''')
+    return connection
+
+
+def session_files(sessionfile):
+    """Return the session database and its WAL and shared memory files."""
+    return [
+        sessionfile,
+        sessionfile.with_name(f"{sessionfile.name}-wal"),
+        sessionfile.with_name(f"{sessionfile.name}-shm"),
+        ]
+
+
+def set_aside_session(sessionfile):
+    """Rename the session files which could not be read so the next
+    session starts in a new file. Return the new name of the database.
+    """
+    aside = sessionfile.with_name(f"{sessionfile.name}.bad")
+    for path, newpath in zip(
+            session_files(sessionfile), session_files(aside)):
+        if path.exists():
+            path.replace(newpath)
+    return aside
+
+
+def apply_session_ops(lines, ops):
+    """Apply journaled list changes to a list of lines in place."""
+    for kind, pos, data in ops:
+        if kind == 'insert':
+            lines[pos:pos] = data
+        elif kind == 'delete':
+            del lines[pos:pos+data]
+    return lines
+
+
+def load_session_lines(connection):
+    """Return the saved list (snapshot plus journal) or None."""
+    row = connection.execute('SELECT text FROM snapshot').fetchone()
+    if not row:
+        return None
+    ops = [
+        json.loads(op) for op, in
+        connection.execute('SELECT op FROM journal ORDER BY id')
+        ]
+    return apply_session_ops(row[0].split('\n'), ops)
+
+
+def read_session(sessionfile):
+    """Return the saved list and state dict of the last session."""
+    if not sessionfile.exists():
+        return None, {}
+    connection = open_session_db(sessionfile)
+    try:
+        lines = load_session_lines(connection)
+        state = {
+            key: json.loads(value) for key, value in
+            connection.execute('SELECT key, value FROM state')
+            }
+    finally:
+        connection.close()
+    return lines, state
+
+
+def write_session_snapshot(connection, lines):
+    """Replace the saved list with `lines` and empty the journal."""
+    connection.execute(
+        'INSERT OR REPLACE INTO snapshot (id, text) VALUES (1, ?)',
+        ('\n'.join(lines),),
+        )
+    connection.execute('DELETE FROM journal')
+
+
+def session_worker(sessionfile, compact_limit=10000):
+    """Thread writing the session journal so the GUI never waits."""
+    connection = open_session_db(sessionfile)
+    journalsize = connection.execute(
+        'SELECT count(*) FROM journal').fetchone()[0]
+    closing = False
+    while not closing:
+        items = [session_queue.get()]
+        while not session_queue.empty():
+            items.append(session_queue.get())
+        with connection:
+            for kind, data in items:
+                if kind == 'op':
+                    connection.execute(
+                        'INSERT INTO journal (op) VALUES (?)',
+                        (json.dumps(data),),
+                        )
+                    journalsize += 1
+                elif kind == 'snapshot':
+                    write_session_snapshot(connection, data)
+                    journalsize = 0
+                elif kind == 'state':
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO state VALUES (?, ?)',
+                        [(k, json.dumps(v)) for k, v in data.items()],
+                        )
+                elif kind == 'close':
+                    closing = True
+            if journalsize > compact_limit or (closing and journalsize):
+                # Fold the journal into the snapshot so restore is one read
+                lines = load_session_lines(connection) or ['']
+                write_session_snapshot(connection, lines)
+                journalsize = 0
+    connection.close()
+
+
+def init_session(sessionfile):
+    """Start the session journal writer thread if a file is given."""
+    global session_queue
+    global session_thread
+    global session_laststate
+    session_queue = None
+    session_thread = None
+    session_laststate = {}
+    if not sessionfile:
+        return False
+    sessionfile.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    session_queue = queue.Queue()
+    session_thread = threading.Thread(
+        target=session_worker, args=(sessionfile,), daemon=True
+        )
+    session_thread.start()
+
+
+def journal_session(kind, data):
+    """Queue a change for the session journal writer thread."""
+    if session_queue:
+        session_queue.put((kind, data))
+
+
+def session_state():
+    """Return the cursor, options, macro keys and template to save."""
+    return {
+        'cursor': current_position() or 0,
+        'skipcommentlines': skipcommentlines.get(),
+        'allowblankline': allowblankline.get(),
+        'reversenextbool': reversenextbool.get(),
+        'watchfile': watchfile.get(),
+        'forward': forward.get(),
+        'repeat': repeat.get(),
+        'selprev': selprev.get(),
+        'selnext': selnext.get(),
+        'nextlist': nextlist.get(),
+        'template': current_template,
+        'lazy': lazy_session_state(),
+        'librarydir': librarydir.get(),
+        'inventoryfile': inventoryfile.get(),
+        }
+
+
+def lazy_session_state():
+    """Return the render recipe of the generated blocks not yet added
+    to the list, without the template text saved with the template,
+    or None if there are none.
+    """
+    if not lazy_expansion:
+        return None
+    recipe = lazy_expansion.recipe
+    return {
+        'values': recipe['values'],
+        'allowblank': recipe['allowblank'],
+        'expanded': recipe.get('expanded', 0),
+        }
+
+
+def save_session_state():
+    """Queue the session state if it changed since the last save."""
+    global session_laststate
+    global session_stateid
+    state = session_state()
+    changed = {
+        k: v for k, v in state.items() if session_laststate.get(k) != v
+        }
+    if changed:
+        journal_session('state', changed)
+        session_laststate = state
+    session_stateid = root.after(2000, save_session_state)
+
+
+def restore_session(sessionfile, restorelist):
+    """Restore the options, macro keys and (if `restorelist`) the list
+    and cursor of the last session. Return True if a session was found.
+    """
+    global current_template
+    global lazy_expansion
+    try:
+        lines, state = read_session(sessionfile)
+    except (sqlite3.Error, ValueError, OSError) as e:
+        lines, state = None, {}
+        try:
+            aside = set_aside_session(sessionfile)
+        except OSError:
+            aside = None
+        title = 'Session not restored'
+        message = f"Could not read {sessionfile}\n{e}"
+        if aside:
+            message += f"\nIt was renamed to {aside.name}"
+        tk.messagebox.showwarning(title=title, message=message)
+    for name, var in (
+            ('skipcommentlines', skipcommentlines),
+            ('allowblankline', allowblankline),
+            ('reversenextbool', reversenextbool),
+            ('watchfile', watchfile),
+            ('forward', forward),
+            ('repeat', repeat),
+            ('selprev', selprev),
+            ('selnext', selnext),
+            ('nextlist', nextlist),
+            ('librarydir', librarydir),
+            ('inventoryfile', inventoryfile),
+            ):
+        if name in ('librarydir', 'inventoryfile') and var.get():
+            # The --templates-dir and --inventory options take precedence
+            continue
+        if name in state:
+            var.set(state[name])
+    if restorelist and lines:
+        list_replace(lines)
+        undo_stack.clear()
+        close_undo_group()
+        current_template = state.get('template')
+        if current_template and state.get('lazy'):
+            # Render the template again to continue after the blocks
+            # the saved list has
+            recipe = {'render': current_template['text'], **state['lazy']}
+            try:
+                _, lazy_expansion = render_recipe(recipe)
+            except (KeyError, ValueError, IndexError, AttributeError):
+                lazy_expansion = None
+        set_listbox_selection(min(state.get('cursor', 0), len(lines) - 1))
+        start_watching()
+    return lines is not None
+
+
+def close_session():
+    """Save the session state and wait for the journal to be written."""
+    if not session_thread:
+        return False
+    root.after_cancel(session_stateid)
+    journal_session('state', session_state())
+    journal_session('close', None)
+    session_thread.join(timeout=10)
+
+
+def open_library_db(libraryfile):
+    """Open the template library index and create its tables.
+    Full-text search uses FTS5 when the sqlite3 library provides it.
+    """
+    global library_fts
+    libraryfile.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(libraryfile)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL
+            )
+        ''')
+    try:
+        connection.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS templates USING fts5(
+                path, varnames, vardefaults, content
+                )
+            ''')
+        library_fts = True
+    except sqlite3.OperationalError:
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS templates (
+                rowid INTEGER PRIMARY KEY,
+                path TEXT, varnames TEXT, vardefaults TEXT, content TEXT
+                )
+            ''')
+        library_fts = False
+    return connection
+
+
+def index_library(connection, directory):
+    """Index the `.txt` templates of a directory tree.
+    Only files which are new or whose mtime or size changed are read.
+    Return the number of files (re)indexed.
+    """
+    indexed = {
+        path: (fileid, mtime, size) for fileid, path, mtime, size in
+        connection.execute('SELECT id, path, mtime, size FROM files')
+        }
+    seen = set()
+    changed = 0
+    for templatefile in sorted(pathlib.Path(directory).rglob('*.txt')):
+        try:
+            stat = templatefile.stat()
+        except OSError:
+            continue
+        path = str(templatefile.resolve())
+        seen.add(path)
+        old = indexed.get(path)
+        if old and old[1:] == (stat.st_mtime, stat.st_size):
+            continue
+        try:
+            text = templatefile.read_text()
+        except (OSError, UnicodeDecodeError):
+            continue
+        varsdict = parse_template_vars(text)
+        with connection:
+            if old:
+                connection.execute('DELETE FROM files WHERE id=?', old[:1])
+                connection.execute(
+                    'DELETE FROM templates WHERE rowid=?', old[:1])
+            fileid = connection.execute(
+                'INSERT INTO files (path, mtime, size) VALUES (?, ?, ?)',
+                (path, stat.st_mtime, stat.st_size),
+                ).lastrowid
+            connection.execute(
+                'INSERT INTO templates (rowid, path, varnames, vardefaults, '
+                'content) VALUES (?, ?, ?, ?, ?)',
+                (
+                    fileid,
+                    path,
+                    ' '.join(varsdict),
+                    ' '.join(' '.join(v) for v in varsdict.values()),
+                    text,
+                    ),
+                )
+        changed += 1
+    with connection:
+        for path, (fileid, *_) in indexed.items():
+            if path not in seen:
+                connection.execute('DELETE FROM files WHERE id=?', (fileid,))
+                connection.execute(
+                    'DELETE FROM templates WHERE rowid=?', (fileid,))
+    return changed
+
+
+def search_library(connection, query, limit=200):
+    """Return (path, variable names) of the templates matching every
+    word of the query in their name, variables, or lines.
+    """
+    words = query.split()
+    if not words:
+        return connection.execute(
+            'SELECT path, varnames FROM templates ORDER BY path LIMIT ?',
+            (limit,),
+            ).fetchall()
+    if library_fts:
+        match = ' '.join(
+            '"' + word.replace('"', '""') + '"*' for word in words
+            )
+        return connection.execute(
+            'SELECT path, varnames FROM templates WHERE templates MATCH ? '
+            'ORDER BY rank LIMIT ?',
+            (match, limit),
+            ).fetchall()
+    where = ' AND '.join(
+        ['(path || varnames || vardefaults || content) LIKE ?'] * len(words)
+        )
+    return connection.execute(
+        f"SELECT path, varnames FROM templates WHERE {where} "
+        'ORDER BY path LIMIT ?',
+        (*[f"%{word}%" for word in words], limit),
+        ).fetchall()
+
+
+def library_window():
+    """Child window to search the template library and import from it."""
+    global library_connection
+    if not library_connection:
+        library_connection = open_library_db(library_file)
+    mylib = tk.Toplevel(root)
+    mylib.title('Template library')
+    mychild = ttk.Frame(mylib, padding=(2,2,2,2))
+    mychild.grid(column=0, row=0, sticky='NWES')
+    mylib.columnconfigure(0, weight=1)
+    mylib.rowconfigure(0, weight=1)
+    mychild.columnconfigure(2, weight=1)
+    mychild.rowconfigure(3, weight=1)
+    lbl1 = ttk.Label(mychild, text='Directory:')
+    lbl1.grid(column=1, row=1, sticky='E')
+    ent1 = ttk.Entry(mychild, textvariable=librarydir, width=50)
+    ent1.grid(column=2, row=1, sticky='WE')
+    btn1 = ttk.Button(mychild, text='Browse')
+    btn1.config(command=lambda: choose_library_dir(mylib, lst1, str1, sts1))
+    btn1.grid(column=3, row=1, sticky='WE')
+    lbl2 = ttk.Label(mychild, text='Search:')
+    lbl2.grid(column=1, row=2, sticky='E')
+    str1 = tk.StringVar()
+    ent2 = ttk.Entry(mychild, textvariable=str1)
+    ent2.grid(column=2, row=2, columnspan=2, sticky='WE')
+    lst1 = tk.Listbox(mychild, height=15, exportselection=False)
+    lst1.grid(column=1, row=3, columnspan=3, sticky='NWES')
+    sts1 = tk.StringVar()
+    lbl3 = ttk.Label(mychild, textvariable=sts1)
+    lbl3.grid(column=1, row=4, columnspan=2, sticky='W')
+    btn2 = ttk.Button(mychild, text='Import')
+    btn2.config(command=lambda: import_from_library(mylib, lst1))
+    btn2.grid(column=3, row=4, sticky='WE')
+    for child in mychild.winfo_children():
+        child.grid_configure(padx=2, pady=2)
+    ent2.bind(
+        '<KeyRelease>',
+        lambda event: update_library_results(lst1, str1.get(), sts1),
+        )
+    lst1.bind('<Double-1>', lambda event: import_from_library(mylib, lst1))
+    lst1.bind('<Return>', lambda event: import_from_library(mylib, lst1))
+    mylib.bind('<Escape>', lambda event: childdismiss(mylib))
+    ent2.focus_set()
+    reindex_library(mylib, lst1, str1, sts1)
+
+
+def choose_library_dir(child, results, query, status):
+    """Ask for the template library directory and index it."""
+    directory = tkinter.filedialog.askdirectory(parent=child)
+    if directory:
+        librarydir.set(directory)
+        reindex_library(child, results, query, status)
+
+
+def reindex_library(child, results, query, status):
+    """Update the index on a separate thread, then refresh the results."""
+    directory = librarydir.get()
+    if not directory or not pathlib.Path(directory).is_dir():
+        status.set('Choose a template directory')
+        update_library_results(results, query.get(), status)
+        return False
+    status.set(f"Indexing {directory} ...")
+    done = queue.Queue()
+    threading.Thread(
+        target=library_index_worker, args=(directory, done), daemon=True
+        ).start()
+    poll_library_index(child, results, query, status, done)
+
+
+def library_index_worker(directory, done):
+    """Thread to index the library with its own database connection."""
+    connection = open_library_db(library_file)
+    try:
+        done.put(index_library(connection, directory))
+    finally:
+        connection.close()
+
+
+def poll_library_index(child, results, query, status, done):
+    """Show the results once the indexing thread is finished."""
+    if not child.winfo_exists():
+        return
+    if done.empty():
+        child.after(
+            50,
+            lambda: poll_library_index(child, results, query, status, done),
+            )
+        return
+    update_library_results(results, query.get(), status)
+
+
+def update_library_results(results, query, status):
+    """Fill the results list with the templates matching the query."""
+    start = time.perf_counter()
+    try:
+        rows = search_library(library_connection, query)
+    except sqlite3.OperationalError:
+        rows = []
+    elapsed = (time.perf_counter() - start) * 1000
+    results.delete(0, 'end')
+    for path, varnames in rows:
+        results.insert('end', f"{path}  [{varnames}]" if varnames else path)
+    library_paths[:] = [path for path, _ in rows]
+    status.set(f"{len(rows)} templates found in {elapsed:.1f} ms")
+    if rows:
+        results.selection_set(0)
+
+
+def import_from_library(child, results):
+    """Import the template selected in the library window."""
+    selected = results.curselection()
+    if not selected:
         return False
+    path = library_paths[selected[0]]
+    childdismiss(child)
+    importfromfile(path)
 
 
 def system_info():
@@ -688,6 +4255,52 @@ def system_info():
     tkinter.messagebox.showinfo(title=title, message=message)
 
 
+def performance_window():
+    """Child window showing the typing pipeline timing percentiles."""
+    myperf = tk.Toplevel(root)
+    myperf.title('Performance')
+    mychild = ttk.Frame(myperf, padding=(2,2,2,2))
+    mychild.grid(column=0, row=0, sticky='NWES')
+    lbl1 = ttk.Label(mychild, font='TkFixedFont')
+    lbl1.grid(column=1, row=1, columnspan=2, sticky='NWES')
+    btn1 = ttk.Button(mychild)
+    btn1.config(text='Reset', command=reset_perf_stats)
+    btn1.grid(column=1, row=2, sticky='EWNS')
+    btn2 = ttk.Button(mychild)
+    btn2.config(text='Close', command=lambda: childdismiss(myperf))
+    btn2.grid(column=2, row=2, sticky='EWNS')
+    myperf.bind('<Escape>', lambda event: childdismiss(myperf))
+    for child in mychild.winfo_children():
+        child.grid_configure(padx=2, pady=2)
+    refresh_performance_window(myperf, lbl1)
+
+
+def refresh_performance_window(child, label):
+    """Redraw the timing percentiles once per second while open."""
+    if not child.winfo_exists():
+        return
+    lines = [f"{'stage':<20}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}"]
+    for stage, stats in perf_summary().items():
+        if stage == 'chars_per_second':
+            unit, scale = 'cps', 1
+        else:
+            unit, scale = 'ms', 1000
+        values = ''.join(
+            f"{stats[p]*scale:>10.1f}" if stats[p] is not None
+            else f"{'-':>10}"
+            for p in ('p50', 'p95', 'p99')
+            )
+        lines.append(f"{stage:<20}{stats['count']:>7}{values}  {unit}")
+    label.config(text='\n'.join(lines))
+    child.after(1000, lambda: refresh_performance_window(child, label))
+
+
+def reset_perf_stats():
+    """Clear the timing samples without reopening the log file."""
+    for samples in perf_samples.values():
+        samples.clear()
+
+
 def about():
     """Show program name, version, and author."""
     title = 'About'
@@ -729,6 +4342,25 @@ def start_keyboard_controller():
         controller.start()
 
 
+def stop_keyboard_controller(timeout=5):
+    """Drop the queued lines and stop the controller thread after the
+    line being typed, which closes the XTest writer. The writer is
+    closed here if the thread was never started.
+    """
+    if not controller.is_alive():
+        if xtest_writer:
+            xtest_writer.close()
+        return
+    while True:
+        try:
+            keyboard_queue.get_nowait()
+        except queue.Empty:
+            break
+        keyboard_queue.task_done()
+    keyboard_queue.put(None)
+    controller.join(timeout)
+
+
 def start_keyboard_threads():
     """Start the keyboard listener and controller."""
     global is_keyboard_hooked
@@ -760,20 +4392,21 @@ def removeblanklines():
         # can't add back in blank lines
         pass
     else:
-        tmpl = [x for x in listbox.get(0, 'end') if x]
-        if tmpl == list(listbox.get(0, 'end')):
-            # no need to remove blank lines or change my curpos
-            pass
-        else:
-            listbox.delete(0, 'end')
-            listbox.insert(0, *tmpl)
+        rows = blank_rows(listlines[:])
+        if len(rows) == len(listlines):
+            # Keep one blank line in a list of blank lines
+            rows = rows[1:]
+        if rows:
+            list_remove(rows)
             set_listbox_selection(0)
 
 
 def jumpovercommentlines():
     """Move the cursor while skipping over comment lines."""
-    curline = listbox.get(listbox.curselection())
-    if skipcommentlines.get() and re.match('^#', curline):
+    curpos = current_position()
+    if curpos is None:
+        return False
+    if skipcommentlines.get() and listlines.is_comment(curpos):
         if reversenextbool.get():
             cyclebackward()
         else:
@@ -838,8 +4471,14 @@ def detect_keyboard():
 
 if __name__ == '__main__':
     # Start of main program
+    if sys.argv[1:2] == ['lint']:
+        sys.exit(lint_main(sys.argv[2:]))
     parser = parse_arguments()
     args = parser.parse_args()
+    init_profiling(args.profile, args.tracemalloc, args.profile_dir)
+    if args.profile:
+        profilers['startup'].enable()
+        profile_state.active = 'startup'
     supported_platforms = {
         'win32': 'Windows',
         'linux': 'Linux',
@@ -853,6 +4492,10 @@ if __name__ == '__main__':
         import Quartz
         # Apple macOS platforms
         bkend = 'darwin'
+        darwin_key_events = frozenset((
+            Quartz.kCGEventKeyDown,  # value = 10
+            Quartz.kCGEventKeyUp,    # value = 11
+            ))
         rootuser = True if shutil.os.geteuid() == 0 else False
         if rootuser:
             print("Running with root user permissions")
@@ -910,6 +4553,33 @@ if __name__ == '__main__':
     keylist = list(keydict.keys())
     lastcbvalue = ''
     hookcbid = ''
+    try:
+        clipboard_filter = re.compile(args.clipboard_filter)
+    except re.error as e:
+        parser.error(f"invalid --clipboard-filter: {e}")
+    clipboard_history = ClipboardHistory(
+        args.clipboard_size, args.clipboard_bytes
+        )
+    clipboard_view = None
+    keypress_time = None
+    init_perf_stats(args.perf_log)
+    init_transcript(args.transcript)
+    init_event_trace(args.record_events)
+    serial_writer = None
+    if args.serial:
+        try:
+            serial_writer = SerialWriter(
+                args.serial, args.baud, args.flow, args.chunk_size,
+                report=report_typing_error,
+                )
+        except (OSError, AttributeError, ImportError) as e:
+            parser.error(f"cannot open serial device {args.serial}: {e}")
+    xtest_writer = None
+    if args.xtest and bkend == 'xorg' and not serial_writer:
+        try:
+            xtest_writer = XTestWriter(report=report_typing_error)
+        except (OSError, ImportError) as e:
+            print(f"Typing with the pynput controller, XTest failed: {e}")
     test_listbox_text = [f'sample text {x+1:02d}' for x in range(25)]
     if not 'uinput_device_paths' in locals():
         uinput_device_paths = None
@@ -922,6 +4592,13 @@ if __name__ == '__main__':
     # Start of tkinter GUI section
     root = tk.Tk()
     root.title(__progname__)
+    root.protocol('WM_DELETE_WINDOW', quit_program)
+    library_file = typelines_dir() / 'library.sqlite3'
+    library_connection = None
+    library_paths = []
+    librarydir = tk.StringVar(value=args.templates_dir or '')
+    inventoryfile = tk.StringVar(value=args.inventory or '')
+    inventory_cache = {}
     root.columnconfigure(0, weight=1)
     root.rowconfigure(0, weight=1)
     mygui = ttk.Frame(root, padding=(2,2,2,2))
@@ -937,17 +4614,24 @@ if __name__ == '__main__':
     mainmenu_file = tk.Menu(mainmenu, tearoff=False)
     mainmenu_file_items = [
         ('Import template or file', importfromfile),
+        ('Re-render with new values', rerender_template),
+        ('Import variable table', import_var_table),
+        ('Next variable row', next_table_row),
+        ('Previous variable row', previous_table_row),
+        ('Template library', library_window),
         ('Save list to file', savelisttofile),
         ]
     for label, command in mainmenu_file_items:
         mainmenu_file.add_command(label=label, command=command)
     mainmenu_file.add_separator()
-    mainmenu_file.add_command(label='Exit', command=root.destroy)
+    mainmenu_file.add_command(label='Exit', command=quit_program)
     mainmenu.add_cascade(label='File', menu=mainmenu_file)
 
     ## Main menu - Actions
     mainmenu_actions = tk.Menu(mainmenu, tearoff=False)
     mainmenu_actions_items = [
+        ('Undo', undo),
+        ('Redo', redo),
         ('Copy selected', copy_item),
         ('Copy selected + Advance', copy_gonext),
         ('Edit selected', edit_item_window),
@@ -955,22 +4639,45 @@ if __name__ == '__main__':
         ('Insert after selected', insert_item_after_window),
         ('Move selected up', moveitemup),
         ('Move selected down', moveitemdown),
+        ('Duplicate selected', duplicateitems),
+        ('Select all', selectallitems),
+        ('Sort selected or all', sortitems),
+        ('Remove duplicate lines', dedupeitems),
+        ('Remove blank lines', stripblanklines),
         ('Delete selected', removeitem),
         ('Delete all items', clearclipboard),
+        ('Clipboard history', clipboard_window),
         ]
     for label, command in mainmenu_actions_items:
         mainmenu_actions.add_command(label=label, command=command)
     mainmenu.add_cascade(label='Actions', menu=mainmenu_actions)
 
+    ## Main menu - Lists
+    mainmenu_lists = tk.Menu(mainmenu, tearoff=False)
+    mainmenu_lists_items = [
+        ('New list', new_list),
+        ('Next list', next_list),
+        ('Close list', close_list),
+        ]
+    for label, command in mainmenu_lists_items:
+        mainmenu_lists.add_command(label=label, command=command)
+    mainmenu_lists.add_separator()
+    lists_menu_first = mainmenu_lists.index('end') + 1
+    activelist = tk.IntVar(value=0)
+    mainmenu.add_cascade(label='Lists', menu=mainmenu_lists)
+
     ## Main menu - Options
     mainmenu_options = tk.Menu(mainmenu, tearoff=False)
     skipcommentlines = tk.BooleanVar(value=True)
     allowblankline = tk.BooleanVar(value=False)
     reversenextbool = tk.BooleanVar(value=False)
+    watchfile = tk.BooleanVar(value=False)
+    watch_state = None
     mainmenu_options_items = [
         ('Skip over comment lines', skipcommentlines, jumpovercommentlines),
         ('Allow blank lines in import', allowblankline, removeblanklines),
         ('Reverse direction of advance', reversenextbool, None),
+        ('Reload imported file when changed', watchfile, start_watching),
         ]
     for l, v, c in mainmenu_options_items:
         mainmenu_options.add_checkbutton(label=l, variable=v, command=c)
@@ -978,7 +4685,15 @@ if __name__ == '__main__':
 
     ## Main menu - Help
     mainmenu_help = tk.Menu(mainmenu, tearoff=False)
-    mainmenu_help_items = [('System Info', system_info), ('About', about)]
+    mainmenu_help_items = [
+        ('System Info', system_info),
+        ('Performance', performance_window),
+        ('About', about),
+        ]
+    if args.profile or args.tracemalloc:
+        mainmenu_help_items.insert(
+            2, ('Write profile reports', save_profile_reports)
+            )
     for label, command in mainmenu_help_items:
         mainmenu_help.add_command(label=label, command=command)
     mainmenu.add_cascade(label='Help', menu=mainmenu_help)
@@ -1038,6 +4753,19 @@ if __name__ == '__main__':
     ui_obj.bind('<<ComboboxSelected>>', lambda event: update_macro_keys())
     ui_objs.append(ui_obj)
 
+    # `Next list` label and combobox
+    nextlist = tk.StringVar(value='F7')
+    ui_obj = ttk.Label(mygui)
+    ui_obj.config(text='`Next list` Key')
+    ui_obj.grid(column=6, row=1, sticky='W')
+    ui_objs.append(ui_obj)
+    ui_obj = ttk.Combobox(mygui)
+    ui_obj.config(textvariable=nextlist, values=keylist, width=5)
+    ui_obj.config(state='readonly')
+    ui_obj.grid(column=6, row=2, sticky='W')
+    ui_obj.bind('<<ComboboxSelected>>', lambda event: update_macro_keys())
+    ui_objs.append(ui_obj)
+
     # `Start/Stop keyboard listener` button
     if userplatform == 'darwin' and not sys.flags.interactive:
         is_keyboard_hooked = True
@@ -1064,36 +4792,80 @@ if __name__ == '__main__':
     ui_objs.append(ui_obj)
 
     # Text List (The data to be typed)
-    listbox_text = tk.StringVar(value=test_listbox_text)
-    selectmode = (tk.BROWSE, tk.EXTENDED, tk.SINGLE, tk.MULTIPLE)[2]
-    activestyle = (tk.UNDERLINE, tk.DOTBOX, tk.NONE)[2]
-    ui_obj = tk.Listbox(mygui, selectmode=selectmode)
-    ui_obj.config(listvariable=listbox_text, height=15)
-    ui_obj.config(exportselection=False, activestyle=activestyle)
-    ui_obj.grid(column=1, columnspan=6, row=3, rowspan=15, sticky='NSWE')
-    ui_obj.bind('<Button-3>', do_rightclickmenu)
-    ui_obj.bind('<Double-1>', lambda event: copy_item())
-    ui_obj.bind('<Triple-1>', lambda event: edit_item_window())
-    ui_obj.bind('<Up>', lambda event: cyclebackward())
-    ui_obj.bind('<Down>', lambda event: cycleforward())
-    ui_obj.bind('<Return>', lambda event: copy_gonext())
-    ui_obj.bind('<Delete>', lambda event: removeitem())
-    ui_obj.bind('<Control-Return>', lambda event: toggle_keyboard_threads())
-    ui_obj.bind('<Control-e>', lambda event: edit_item_window())
-    ui_obj.bind('<Control-i>', lambda event: insert_item_after_window())
-    ui_obj.bind('<Control-o>', lambda event: importfromfile())
-    ui_obj.bind('<Control-s>', lambda event: savelisttofile())
-    ui_objs.append(ui_obj)
-    listbox = ui_obj
+    listlines = LineStore(test_listbox_text)
+    listrecipe = None
+    undo_stack = []
+    redo_stack = []
+    undo_group = None
+    undo_replaying = False
+    undo_limit = 1000
+    current_template = None
+    lazy_expansion = None
+    var_table = None
+    compiled_file = None if args.no_cache else args.cache
+    listbox_text = tk.StringVar(value=listlines)
+    listbox = make_listbox(listbox_text)
+    ui_objs.append(listbox)
+    pending_selection = None
+    pending_focus = ''
+    refresh_id = None
+    last_refresh = 0
+    lists = [{}]
+    active_list = 0
+    update_lists_menu()
     set_listbox_selection(0)
 
-    # Right click menu for copy and select all
-    rightclickmenu = tk.Menu(listbox, tearoff=False)
+    # Right click menu for copy and select all, on root since the
+    # listboxes are destroyed when their lists are closed
+    rightclickmenu = tk.Menu(root, tearoff=False)
     rightclickmenu_items = mainmenu_actions_items
     for label, command in rightclickmenu_items:
         rightclickmenu.add_command(label=label, command=command)
     ui_objs.append(rightclickmenu)
 
+    # Search and jump to line bar below the Text List
+    searchbar = ttk.Frame(mygui)
+    searchbar.grid(column=1, columnspan=6, row=18, sticky='WE')
+    searchbar.columnconfigure(2, weight=1)
+    searchtext = tk.StringVar()
+    searchregex = tk.BooleanVar(value=False)
+    jumptext = tk.StringVar()
+    searchstatus = tk.StringVar()
+    search_index = None
+    search_matches = []
+    search_key = None
+    ui_obj = ttk.Label(searchbar, text='Find:')
+    ui_obj.grid(column=1, row=1, sticky='E')
+    ui_obj = ttk.Entry(searchbar, textvariable=searchtext)
+    ui_obj.grid(column=2, row=1, sticky='WE')
+    ui_obj.bind('<KeyRelease>', lambda event: update_search()
+        if event.keysym not in ('Return', 'Escape') else None)
+    ui_obj.bind('<Return>', lambda event: update_search(1))
+    ui_obj.bind('<Shift-Return>', lambda event: update_search(-1))
+    ui_obj.bind('<Escape>', lambda event: listbox.focus())
+    searchentry = ui_obj
+    ui_obj = ttk.Checkbutton(searchbar, text='Regex', variable=searchregex)
+    ui_obj.config(command=update_search)
+    ui_obj.grid(column=3, row=1)
+    ui_obj = ttk.Button(searchbar, text='Prev', width=5)
+    ui_obj.config(command=lambda: update_search(-1))
+    ui_obj.grid(column=4, row=1)
+    ui_obj = ttk.Button(searchbar, text='Next', width=5)
+    ui_obj.config(command=lambda: update_search(1))
+    ui_obj.grid(column=5, row=1)
+    ui_obj = ttk.Label(searchbar, text='Line:')
+    ui_obj.grid(column=6, row=1, sticky='E')
+    ui_obj = ttk.Entry(searchbar, textvariable=jumptext, width=7)
+    ui_obj.grid(column=7, row=1)
+    ui_obj.bind('<Return>', lambda event: jump_to_line())
+    ui_obj.bind('<Escape>', lambda event: listbox.focus())
+    jumpentry = ui_obj
+    ui_obj = ttk.Label(searchbar, textvariable=searchstatus, width=22)
+    ui_obj.grid(column=8, row=1, sticky='W')
+    for child in searchbar.winfo_children():
+        child.grid_configure(padx=2)
+    ui_objs.append(searchbar)
+
     # Scroll bar for the Text List
     scrollbar = ttk.Scrollbar(mygui)
     scrollbar.config(orient=tk.VERTICAL, command=listbox.yview)
@@ -1122,6 +4894,22 @@ if __name__ == '__main__':
         start_keyboard_listener()
         start_keyboard_controller()
 
+    if args.profile:
+        profilers['startup'].disable()
+        profile_state.active = None
+
+    init_session(None)
+    if not args.no_session:
+        restored = restore_session(
+            args.session, restorelist=not args.filename
+            )
+        update_macro_keys()
+        init_session(args.session)
+        if not restored:
+            journal_session('snapshot', listlines.copy())
+        save_session_state()
+        update_lists_menu()
+
     if args.filename:
         importfromfile(args.filename)
 